@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Dirk Müller, SUSE LLC
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+SPDX-License-Identifier: GPL-2.0-or-later
+"""
+
+import argparse
+import collections
+import configparser
+import json
+import re
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import patch
+
+import slacky
+
+# Representative event bodies as posted on the pubsub exchange
+SAMPLE_EVENTS: dict[str, bytes] = {
+    'suse.openqa.job.done': json.dumps(
+        {
+            'ARCH': 'x86_64',
+            'BUILD': 'sle-15-SP6-Containers:7.12',
+            'FLAVOR': 'Updates',
+            'HDD_1': 'SLES-15-SP6-x86_64-Build7.12-Server-DVD-Updates-64bit.qcow2',
+            'MACHINE': '64bit',
+            'TEST': 'bci_test_podman',
+            'bugref': None,
+            'group_id': 444,
+            'id': 13243521,
+            'newbuild': None,
+            'reason': None,
+            'remaining': 17,
+            'result': 'failed',
+        }
+    ).encode(),
+    'suse.obs.package.build_fail': json.dumps(
+        {
+            'arch': 'aarch64',
+            'build_host': 'obs-power8-03',
+            'buildtype': 'kiwi',
+            'package': 'bci-python-3.11',
+            'previouslyfailed': None,
+            'project': 'SUSE:SLE-15-SP6:Update:BCI',
+            'readytime': '1697352034',
+            'release': '8.3',
+            'reason': 'new build',
+            'repository': 'images',
+            'srcmd5': 'b1b71f52fb0d1a8d2e1e92a5b1df2ee1',
+            'starttime': '1697352040',
+            'endtime': '1697352980',
+            'versrel': '3.11-8.3',
+            'workerid': 'obs-power8-03:4',
+        }
+    ).encode(),
+}
+
+
+SAMPLE_EVENT_TYPES = {
+    'suse.openqa.job.done': slacky.openQAJobEvent,
+    'suse.obs.package.build_fail': slacky.obsPackageEvent,
+}
+
+
+def _rate(func, body: bytes, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(body)
+    return iterations / (time.perf_counter() - start)
+
+
+def bench_decoders(iterations: int) -> None:
+    """Print messages/second for every available JSON decoder and sample."""
+    for name, decoder in slacky.JSON_DECODERS.items():
+        slacky.select_json_decoder(name)
+        for routing_key, body in SAMPLE_EVENTS.items():
+            event_type = SAMPLE_EVENT_TYPES[routing_key]
+            print(
+                f'{name:8} {routing_key:30}'
+                f' {_rate(decoder, body, iterations):12,.0f} msgs/s (dict)'
+                f' {_rate(lambda b: slacky.decode_event(event_type, b), body, iterations):12,.0f} msgs/s (struct)'
+            )
+    slacky.select_json_decoder()
+
+
+# Configuration for replays, with slack posts going nowhere
+REPLAY_CONF = {
+    'DEFAULT': {'slack_trigger_url': 'https://slack.invalid/replay'},
+    'obs': {
+        'host': 'https://build.suse.de/',
+        'project_re': r'^SUSE:SLE-15-SP\d+:Update:BCI',
+        'repo_re': r'^SUSE:Containers:',
+    },
+    'openqa': {'host': 'https://openqa.suse.de/'},
+}
+
+
+def load_events(path: str) -> list[tuple[str, bytes]]:
+    """Read recorded events, one {"routing_key": ..., "body": ...} per line.
+
+    The body is either the raw event as string or its decoded JSON.
+    """
+    events = []
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            body = record['body']
+            if not isinstance(body, str):
+                body = json.dumps(body)
+            events.append((record['routing_key'], body.encode()))
+    return events
+
+
+def replay(
+    events: list[tuple[str, bytes]], repeat: int = 1, state_store: str = 'none'
+) -> dict:
+    """Feed events through Slacky.dispatch() with slack posts stubbed out."""
+    posts = 0
+
+    def post(payload: dict, session=None) -> bool:
+        nonlocal posts
+        posts += 1
+        return True
+
+    slacky.CONF = configparser.ConfigParser()
+    slacky.CONF.read_dict(REPLAY_CONF)
+    latencies = collections.defaultdict(list)
+    with (
+        tempfile.TemporaryDirectory() as state_dir,
+        patch('slacky._post_to_slack', post),
+    ):
+        bot = slacky.Slacky()
+        bot.project_re = re.compile(slacky.CONF['obs']['project_re'])
+        bot.repo_re = re.compile(slacky.CONF['obs']['repo_re'])
+        if state_store != 'none':
+            slacky.CONF['DEFAULT'].update(state_store=state_store, state_dir=state_dir)
+            bot.store = slacky.open_state_store(slacky.CONF['DEFAULT'])
+            bot.load_state()
+
+        resolve = bot.dispatcher.resolve
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for routing_key, body in events:
+                handler = resolve(routing_key)
+                started = time.perf_counter()
+                bot.dispatch(routing_key, body)
+                latencies[handler.__name__ if handler else '(unrouted)'].append(
+                    time.perf_counter() - started
+                )
+        elapsed = time.perf_counter() - start
+        bot.flush_build_failures(force=True)
+        # counted in the store for sqlite, so before closing it
+        state = bot.state_sizes()
+        if bot.store is not None:
+            bot.store.close()
+    return {
+        'events': len(events) * repeat,
+        'elapsed': elapsed,
+        'posts': posts,
+        'latencies': latencies,
+        'state': state,
+    }
+
+
+def _percentile(ordered: list[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def bench_replay(path: str, repeat: int, state_store: str) -> None:
+    """Print throughput, handler latencies and peak memory of a replay."""
+    events = load_events(path)
+    result = replay(events, repeat, state_store)
+    print(
+        f'{result["events"]:,} events in {result["elapsed"]:.2f} s:'
+        f' {result["events"] / result["elapsed"]:,.0f} msgs/s,'
+        f' {result["posts"]} slack posts'
+    )
+    print(
+        f'{"handler":30} {"events":>9}'
+        f' {"p50 µs":>9} {"p90 µs":>9} {"p99 µs":>9} {"max µs":>9}'
+    )
+    for handler, samples in sorted(result['latencies'].items()):
+        ordered = sorted(samples)
+        print(
+            f'{handler:30} {len(ordered):9,}'
+            + ''.join(
+                f' {_percentile(ordered, q) * 1e6:9.1f}' for q in (0.5, 0.9, 0.99, 1)
+            )
+        )
+    print(f'state: {result["state"]}')
+
+    # a separate run, tracing allocations slows down the replay
+    tracemalloc.start()
+    replay(events, repeat, state_store)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'peak memory: {peak / 2**20:.1f} MiB')
+
+
+def main():
+    parse = argparse.ArgumentParser(description='Benchmarks for slacky')
+    parse.add_argument('-n', '--iterations', type=int, default=100_000)
+    parse.add_argument(
+        '--replay',
+        metavar='EVENTS',
+        help='replay recorded events from a JSON lines file instead',
+    )
+    parse.add_argument(
+        '--repeat', type=int, default=1, help='replay the events this many times'
+    )
+    parse.add_argument(
+        '--state-store',
+        choices=('none', 'snapshot', 'journal', 'sqlite'),
+        default='none',
+        help='persist the state during the replay',
+    )
+    parse.add_argument(
+        '--json-decoder',
+        choices=('auto', *slacky.JSON_DECODERS),
+        default='auto',
+        help='JSON backend used for the replay',
+    )
+    args = parse.parse_args()
+    if args.replay:
+        slacky.select_json_decoder(args.json_decoder)
+        bench_replay(args.replay, args.repeat, args.state_store)
+    else:
+        bench_decoders(args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,27 +15,55 @@ GNU General Public License for more details.
 SPDX-License-Identifier: GPL-2.0-or-later
 """
 
+import abc
 import argparse
+import asyncio
 import collections
 import configparser
+import contextvars
+import cProfile
+import functools
+import heapq
+import http.server
+import io
+import itertools
 import json
 import logging as LOG
 import os
 import pickle
+import pstats
+import queue
 import random
 import re
+import resource
+import shutil
 import signal
+import sqlite3
+import struct
 import sys
+import threading
 import time
 import urllib.parse
-from dataclasses import dataclass
+import zlib
+from collections.abc import Callable, MutableMapping
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from pathlib import Path
 
 import pika
 import requests
+from pika.adapters.asyncio_connection import AsyncioConnection
 from pika.adapters.blocking_connection import BlockingChannel
 
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 CONF = configparser.ConfigParser(strict=False)
 OPENQA_GROUPS_FILTER: tuple[int] = (
     623,
@@ -57,26 +85,801 @@ HANGING_REPO_PUBLISH = timedelta(minutes=55)
 HANGING_CONTAINER_TAG = timedelta(days=10)
 OPENQA_FAIL_WAIT = timedelta(minutes=50)
 
+STATE_DIR = Path(__file__).resolve().parent
+BUILD_FAIL_DIGEST_PACKAGES = 10
+
+# Routing key prefixes of the events handled by each Slacky event handler
+EVENT_ROUTES: dict[str, tuple[str, str]] = {
+    'openqa': ('suse.openqa', 'handle_openqa_event'),
+    'obs_package': ('suse.obs.package', 'handle_obs_package_event'),
+    'obs_request': ('suse.obs.request', 'handle_obs_request_event'),
+    'obs_repo': ('suse.obs.repo', 'handle_obs_repo_event'),
+    'container': ('suse.obs.container', 'handle_container_event'),
+}
+
+# Event handlers and the pubsub routing keys they need to be bound to
+EVENT_BINDINGS: dict[str, tuple[str, ...]] = {
+    'openqa': ('suse.openqa.job.*',),
+    'obs_package': ('suse.obs.package.build_fail',),
+    'obs_request': ('suse.obs.request.*',),
+    'obs_repo': ('suse.obs.repo.*',),
+    'container': ('suse.obs.container.published',),
+}
+
+# Slack posts scheduled by the asyncio consumer which have not completed yet
+PENDING_POSTS: set[asyncio.Task] = set()
+# Pooled session of the running Slacky for the slack posts, see SlackSession
+SLACK_SESSION: requests.Session | None = None
+
+
+class LagTracker:
+    """Recent lag samples in seconds, warning once the threshold is exceeded"""
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, name: str, threshold: float = 60, window: int = 1000):
+        self.name = name
+        self.threshold = threshold
+        self.samples: collections.deque[float] = collections.deque(maxlen=window)
+        self.lagging = False
+
+    def record(self, lag: float) -> None:
+        self.samples.append(lag)
+        if lag > self.threshold:
+            if not self.lagging:
+                self.lagging = True
+                LOG.warning(
+                    '%s lag of %.0fs exceeds %.0fs', self.name, lag, self.threshold
+                )
+        elif self.lagging:
+            self.lagging = False
+            LOG.info('%s lag is back to %.0fs', self.name, lag)
+
+    def percentiles(self) -> dict[str, float]:
+        """Quantiles of the recent samples, empty if there are none."""
+        if not self.samples:
+            return {}
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+        result = {
+            str(q): ordered[min(last, int(q * len(ordered)))] for q in self.QUANTILES
+        }
+        result['1'] = ordered[last]
+        return result
+
+
+# Broker timestamp of the event being handled, None outside of event handlers
+EVENT_TIME: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    'EVENT_TIME', default=None
+)
+# Time from an event reaching the broker to the notification it caused
+NOTIFICATION_LAG = LagTracker('Notification')
+
 
 def post_failure_notification_to_slack(status, body, link_to_failure) -> None:
     """Post a message to slack with the given parameters by using a webhook."""
     LOG.debug(
-        f'post_failure_notification_to_slack({status}, {body}, {link_to_failure})'
+        'post_failure_notification_to_slack(%s, %s, %s)', status, body, link_to_failure
     )
 
     if not CONF['DEFAULT'].get('slack_trigger_url'):
         LOG.debug('Slack notifications are disabled')
         return
 
-    resp = requests.post(
-        url=CONF['DEFAULT']['slack_trigger_url'],
-        headers={'Content-Type': 'application/json'},
-        json={'status': status, 'body': body, 'link_to_failure': link_to_failure},
-    )
+    payload = {'status': status, 'body': body, 'link_to_failure': link_to_failure}
+    if (event_time := EVENT_TIME.get()) is not None:
+        # stripped again before posting, only used for the notification lag
+        payload['event_time'] = event_time
+    if OUTBOX is not None:
+        OUTBOX.put(payload)
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _post_to_slack(payload, SLACK_SESSION)
+    else:
+        task = loop.create_task(_post_to_slack_async(payload, SLACK_SESSION))
+        PENDING_POSTS.add(task)
+        task.add_done_callback(PENDING_POSTS.discard)
+
+
+class SlackSession(requests.Session):
+    """Keep-alive session for the slack webhook with a bounded connection pool."""
+
+    def __init__(self, pool_size: int = 4, timeout: float = 10, retries: int = 2):
+        super().__init__()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retries
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
+
+
+def _post_to_slack(payload: dict, session: requests.Session | None = None) -> bool:
+    """Send the payload to the slack webhook, blocking until it is answered."""
+    start = time.perf_counter()
+    posted = False
+    event_time = payload.get('event_time')
     try:
+        resp = (session or requests).post(
+            url=CONF['DEFAULT']['slack_trigger_url'],
+            headers={'Content-Type': 'application/json'},
+            json={k: v for k, v in payload.items() if k != 'event_time'},
+        )
         resp.raise_for_status()
+        posted = True
+        if event_time is not None:
+            NOTIFICATION_LAG.record(time.time() - event_time)
     except requests.HTTPError as err:
-        LOG.error(f'Failed to post failure notification to slack: {err}')
+        LOG.error('Failed to post failure notification to slack: %s', err)
+    finally:
+        if METRICS is not None:
+            METRICS.observe(
+                'slacky_slack_post_duration_seconds', time.perf_counter() - start
+            )
+            if not posted:
+                METRICS.inc('slacky_slack_post_failures_total')
+    return posted
+
+
+async def _post_to_slack_async(
+    payload: dict, session: requests.Session | None = None
+) -> None:
+    """Await the webhook post in the default executor to keep the loop responsive."""
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, _post_to_slack, payload, session
+        )
+    except requests.RequestException as err:
+        LOG.error('Failed to post failure notification to slack: %s', err)
+
+
+class SlackOutbox:
+    """Bounded queue of slack notifications drained by sender threads.
+
+    The senders share ``session`` so that bursts reuse its pooled
+    connections instead of doing a TLS handshake per post. When the queue
+    is full, ``overflow`` decides what happens: ``drop_oldest`` discards
+    the longest waiting notification, ``drop_newest`` discards the new one
+    and ``block`` waits for the sender to make room.
+    """
+
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(
+        self,
+        maxsize: int = 1000,
+        overflow: str = 'drop_oldest',
+        session: requests.Session | None = None,
+        senders: int = 1,
+    ):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown outbox overflow policy {overflow!r}')
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.overflow = overflow
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.session = session
+        self._threads = [
+            threading.Thread(target=self._drain, name=f'slack-outbox-{n}', daemon=True)
+            for n in range(senders)
+        ]
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
+
+    def put(self, payload: dict) -> None:
+        """Queue a notification for the sender thread, applying the overflow policy."""
+        try:
+            self.queue.put(payload, block=self.overflow == 'block')
+        except queue.Full:
+            self.dropped += 1
+            if self.overflow == 'drop_newest':
+                LOG.warning('Slack outbox full, dropped notification %s', payload)
+                return
+            try:
+                dropped = self.queue.get_nowait()
+                self.queue.task_done()
+                LOG.warning('Slack outbox full, dropped notification %s', dropped)
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(payload)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Send what is still queued and terminate the sender threads.
+
+        Gives up after timeout seconds and drops what was not sent by then.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        def remaining() -> float | None:
+            if deadline is None:
+                return None
+            return max(0.0, deadline - time.monotonic())
+
+        running = [thread for thread in self._threads if thread.is_alive()]
+        try:
+            for _ in running:
+                self.queue.put(None, timeout=remaining())
+        except queue.Full:
+            pass
+        for thread in running:
+            thread.join(remaining())
+        unsent = 0
+        while True:
+            try:
+                if self.queue.get_nowait() is not None:
+                    unsent += 1
+            except queue.Empty:
+                break
+        if unsent:
+            self.dropped += unsent
+            LOG.warning('Slack outbox stopped, dropped %d unsent notifications', unsent)
+
+    def _drain(self) -> None:
+        while (payload := self.queue.get()) is not None:
+            try:
+                if _post_to_slack(payload, self.session):
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            except requests.RequestException as err:
+                self.failed += 1
+                LOG.error('Failed to post failure notification to slack: %s', err)
+            finally:
+                self.queue.task_done()
+        self.queue.task_done()
+
+
+# Outbox used by post_failure_notification_to_slack, posts inline when unset
+OUTBOX: SlackOutbox | None = None
+
+
+def start_outbox(
+    maxsize: int,
+    overflow: str,
+    session: requests.Session | None = None,
+    senders: int = 1,
+) -> None:
+    """Route slack notifications through background sender threads."""
+    global OUTBOX
+    OUTBOX = SlackOutbox(maxsize, overflow, session, senders)
+    OUTBOX.start()
+
+
+def stop_outbox(timeout: float | None = None) -> None:
+    """Flush pending slack notifications and go back to posting inline."""
+    global OUTBOX
+    if OUTBOX is not None:
+        OUTBOX.stop(timeout)
+        LOG.info('Slack outbox stopped: %s', OUTBOX.stats())
+        OUTBOX = None
+
+
+def routing_key_family(routing_key: str) -> str:
+    """Routing key without the event name, e.g. suse.openqa.job"""
+    return routing_key.rpartition('.')[0]
+
+
+def current_rss() -> int | None:
+    """Resident set size of this process in bytes, None without /proc"""
+    try:
+        with open('/proc/self/statm', encoding='ascii') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+class Metrics:
+    """Counters, histograms and gauges in the Prometheus text format.
+
+    Series are created on first use and identified by the metric name and
+    their label values. Gauges are collected from callbacks when rendered.
+    """
+
+    # (type, help) of the metrics slacky exports
+    METRICS = {
+        'slacky_messages_received_total': (
+            'counter',
+            'Events received, by routing key family',
+        ),
+        'slacky_messages_filtered_total': (
+            'counter',
+            'Events dropped without a handler or by the handler filters',
+        ),
+        'slacky_messages_handled_total': (
+            'counter',
+            'Events processed by a handler, by routing key family',
+        ),
+        'slacky_handler_duration_seconds': (
+            'histogram',
+            'Time spent in the event handlers',
+        ),
+        'slacky_slack_post_duration_seconds': (
+            'histogram',
+            'Duration of slack webhook posts',
+        ),
+        'slacky_slack_post_failures_total': (
+            'counter',
+            'Slack webhook posts that failed',
+        ),
+        'slacky_check_duration_seconds': (
+            'histogram',
+            'Duration of check_pending_requests()',
+        ),
+        'slacky_state_entries': ('gauge', 'Number of entries in each state map'),
+        'slacky_slack_outbox_depth': (
+            'gauge',
+            'Slack notifications waiting in the outbox',
+        ),
+        'slacky_consumer_lag_seconds': (
+            'gauge',
+            'Time from events reaching the broker to handling them',
+        ),
+        'slacky_notification_lag_seconds': (
+            'gauge',
+            'Time from events reaching the broker to their slack notification',
+        ),
+    }
+    BUCKETS = (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+        0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    )  # fmt: skip
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[tuple, float]] = collections.defaultdict(dict)
+        # bucket counts followed by the sum and count of the observations
+        self._histograms: dict[str, dict[tuple, list]] = collections.defaultdict(dict)
+        self._gauges: dict[str, tuple[str, Callable[[], dict]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(labels.items())
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(labels.items())
+        with self._lock:
+            series = self._histograms[name]
+            if (buckets := series.get(key)) is None:
+                buckets = series[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+                    break
+            buckets[-2] += value
+            buckets[-1] += 1
+
+    def gauge(self, name: str, label: str, collect: Callable[[], dict]) -> None:
+        """Report collect() as value per label value when rendering."""
+        self._gauges[name] = (label, collect)
+
+    @staticmethod
+    def _series(name: str, labels: tuple, value: float) -> str:
+        if labels:
+            labels = ','.join(f'{key}="{val}"' for key, val in labels)
+            return f'{name}{{{labels}}} {value}'
+        return f'{name} {value}'
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                name: {key: list(buckets) for key, buckets in series.items()}
+                for name, series in self._histograms.items()
+            }
+        gauges = {
+            name: {((label, key),): value for key, value in collect().items()}
+            for name, (label, collect) in self._gauges.items()
+        }
+        for name, (kind, help) in self.METRICS.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            values = {**counters.get(name, {}), **gauges.get(name, {})}
+            for labels, value in values.items():
+                lines.append(self._series(name, labels, value))
+            for labels, buckets in histograms.get(name, {}).items():
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, buckets):
+                    cumulative += count
+                    lines.append(
+                        self._series(
+                            f'{name}_bucket', (*labels, ('le', bound)), cumulative
+                        )
+                    )
+                lines.append(
+                    self._series(
+                        f'{name}_bucket', (*labels, ('le', '+Inf')), buckets[-1]
+                    )
+                )
+                lines.append(self._series(f'{name}_sum', labels, buckets[-2]))
+                lines.append(self._series(f'{name}_count', labels, buckets[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve METRICS on /metrics"""
+
+    def do_GET(self) -> None:
+        if self.path.partition('?')[0] != '/metrics' or METRICS is None:
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        LOG.debug('metrics: ' + format, *args)
+
+
+# Metrics recorded while set, see start_metrics()
+METRICS: Metrics | None = None
+METRICS_SERVER: http.server.ThreadingHTTPServer | None = None
+
+
+def start_metrics(port: int, address: str = 'localhost') -> Metrics:
+    """Record metrics and serve them over HTTP on a background thread."""
+    global METRICS, METRICS_SERVER
+    METRICS = Metrics()
+    METRICS_SERVER = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(
+        target=METRICS_SERVER.serve_forever, name='slacky-metrics', daemon=True
+    ).start()
+    LOG.info('Serving metrics on %s:%d/metrics', address, METRICS_SERVER.server_port)
+    return METRICS
+
+
+def stop_metrics() -> None:
+    """Stop serving and recording metrics."""
+    global METRICS, METRICS_SERVER
+    if METRICS_SERVER is not None:
+        METRICS_SERVER.shutdown()
+        METRICS_SERVER.server_close()
+        METRICS_SERVER = None
+    METRICS = None
+
+
+# JSON decoders for event bodies, preferred first
+JSON_DECODERS: dict[str, Callable] = {}
+if msgspec is not None:
+    JSON_DECODERS['msgspec'] = msgspec.json.Decoder().decode
+if orjson is not None:
+    JSON_DECODERS['orjson'] = orjson.loads
+JSON_DECODERS['json'] = json.loads
+
+decode_json = next(iter(JSON_DECODERS.values()))
+
+
+def select_json_decoder(name: str = 'auto') -> None:
+    """Use the given JSON backend for all event handlers, 'auto' for the fastest."""
+    global decode_json
+    if name == 'auto':
+        name = next(iter(JSON_DECODERS))
+    elif name not in JSON_DECODERS:
+        raise ValueError(
+            f'JSON decoder {name!r} is not available, choose from {", ".join(JSON_DECODERS)}'
+        )
+    decode_json = JSON_DECODERS[name]
+    LOG.debug('Using %s to decode events', name)
+
+
+# returned by peek_json_field() when only a full parse can tell the value
+UNCERTAIN = object()
+
+
+@functools.cache
+def _json_field_re(field: str, raw: bool) -> re.Pattern:
+    # plain strings without escapes, integers and constants only
+    pattern = (
+        rf'"{re.escape(field)}"\s*:\s*'
+        r'(?:"([^"\\]*)"|(-?[0-9]+)\b(?![.eE])|(true|false|null))'
+    )
+    return re.compile(pattern.encode() if raw else pattern)
+
+
+def peek_json_field(body: bytes | str, field: str):
+    """Look up a scalar field in a flat JSON object without parsing all of it.
+
+    Returns UNCERTAIN unless the field name occurs exactly once and has a
+    plain value, so that a rejection based on the result is always safe.
+    """
+    key = f'"{field}"'
+    raw = isinstance(body, bytes)
+    if body.count(key.encode() if raw else key) != 1:
+        return UNCERTAIN
+    match = _json_field_re(field, raw).search(body)
+    if not match:
+        return UNCERTAIN
+    string, number, constant = match.groups()
+    if string is not None:
+        return string.decode() if raw else string
+    if number is not None:
+        return int(number)
+    return {'true': True, 'false': False, 'null': None}[
+        constant.decode() if raw else constant
+    ]
+
+
+# Event structs hold just the fields that slacky uses. The field names
+# follow the JSON payloads so that they can be decoded without renaming.
+@dataclass(slots=True)
+class openQAJobEvent:
+    """suse.openqa.job.* event"""
+
+    group_id: int | None = None
+    BUILD: str | None = None
+    TEST: str | None = None
+    ARCH: str | None = None
+    result: str | None = None
+    reason: str | None = None
+
+
+@dataclass(slots=True)
+class obsPackageEvent:
+    """suse.obs.package.* event"""
+
+    project: str = ''
+    package: str | None = None
+    repository: str | None = None
+    arch: str | None = None
+    previouslyfailed: str | None = None
+
+
+@dataclass(slots=True)
+class obsRepoEvent:
+    """suse.obs.repo.* event"""
+
+    project: str = ''
+    repo: str | None = None
+    state: str | None = None
+
+
+@dataclass(slots=True)
+class obsRequestAction:
+    """Action of a build service request"""
+
+    type: str | None = None
+    targetproject: str = ''
+    targetpackage: str | None = None
+
+
+@dataclass(slots=True)
+class obsRequestEvent:
+    """suse.obs.request.* event"""
+
+    number: int | None = None
+    state: str | None = None
+    actions: list[obsRequestAction] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, msg: dict) -> 'obsRequestEvent':
+        event = _from_dict(cls, msg)
+        event.actions = [_from_dict(obsRequestAction, a) for a in event.actions]
+        return event
+
+
+@dataclass(slots=True)
+class obsContainerEvent:
+    """suse.obs.container.* event"""
+
+    project: str = ''
+    container: str | None = None
+
+
+def _from_dict(cls, msg: dict):
+    return cls(**{f: msg[f] for f in cls.__match_args__ if f in msg})
+
+
+@functools.cache
+def _event_decoder(cls):
+    return msgspec.json.Decoder(cls)
+
+
+@functools.cache
+def _event_builder(cls) -> Callable:
+    return getattr(cls, 'from_dict', None) or functools.partial(_from_dict, cls)
+
+
+def decode_event(cls, body: bytes | str):
+    """Decode an event body into the event struct cls.
+
+    With msgspec the struct is decoded straight from the raw bytes. Bodies
+    that do not fit the struct types and all other JSON backends go
+    through a generic dict instead.
+    """
+    if decode_json is JSON_DECODERS.get('msgspec'):
+        try:
+            return _event_decoder(cls).decode(body)
+        except msgspec.ValidationError:
+            pass
+    return _event_builder(cls)(decode_json(body))
+
+
+class Dispatcher:
+    """Map AMQP routing keys to event handlers.
+
+    Handlers are registered either for an exact routing key or for all keys
+    below a dot separated prefix, where the longest registered prefix wins.
+    Resolved keys are cached, so dispatching is a single dict lookup for
+    every routing key seen before.
+    """
+
+    def __init__(self):
+        self._exact: dict[str, Callable] = {}
+        self._prefixes: dict = {}
+        self._cache: dict[str, Callable | None] = {}
+
+    def register(self, routing_key: str, handler: Callable, prefix=False) -> None:
+        if prefix:
+            node = self._prefixes
+            for part in routing_key.split('.'):
+                node = node.setdefault(part, {})
+            node[None] = handler
+        else:
+            self._exact[routing_key] = handler
+        self._cache.clear()
+
+    def resolve(self, routing_key: str) -> Callable | None:
+        try:
+            return self._cache[routing_key]
+        except KeyError:
+            pass
+        handler = self._exact.get(routing_key)
+        if handler is None:
+            node = self._prefixes
+            handler = node.get(None)
+            for part in routing_key.split('.'):
+                if (node := node.get(part)) is None:
+                    break
+                handler = node.get(None, handler)
+        self._cache[routing_key] = handler
+        return handler
+
+
+class DeadlineScheduler:
+    """Min-heap of deadlines of tracked items, keyed by kind and item key.
+
+    Entries are not removed when an item changes or goes away. Callers
+    check every expired entry against the current state of its item
+    instead, so outdated entries are dropped when they expire. Items whose
+    deadline keeps moving use schedule_once() to have a single entry, which
+    the caller schedules again when it expires before the item is due.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int, str, object]] = []
+        self._counter = itertools.count()
+        # (kind, key) of the items scheduled with schedule_once()
+        self._once: set[tuple[str, object]] = set()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, deadline: datetime, kind: str, key) -> None:
+        heapq.heappush(self._heap, (deadline, next(self._counter), kind, key))
+
+    def schedule_once(self, deadline: datetime, kind: str, key) -> None:
+        """Schedule unless the item has an entry from schedule_once() already."""
+        if (kind, key) not in self._once:
+            self._once.add((kind, key))
+            self.schedule(deadline, kind, key)
+
+    def clear(self) -> None:
+        self._heap.clear()
+        self._once.clear()
+
+    def pop_expired(self, now: datetime) -> collections.defaultdict[str, dict]:
+        """Remove and return {kind: {key: deadline}} for deadlines before now."""
+        expired = collections.defaultdict(dict)
+        while self._heap and self._heap[0][0] < now:
+            deadline, _, kind, key = heapq.heappop(self._heap)
+            self._once.discard((kind, key))
+            expired[kind][key] = deadline
+        return expired
+
+
+class StateJournal:
+    """Append-only log of the state mutations since the last snapshot.
+
+    Every record is a JSON line flushed to the OS right away, so a crash of
+    slacky loses nothing that was journaled. With fsync, records also
+    survive the machine going down, at the cost of a disk sync per record.
+    """
+
+    DATETIME_FIELDS = frozenset(
+        ('created_at', 'finished_at', 'state_changed', 'published_at')
+    )
+
+    def __init__(self, path: Path, fsync: bool = False):
+        self.path = path
+        self.rotated_path = path.with_name(f'{path.name}.old')
+        self.fsync = fsync
+        self.records = 0
+        self._file = open(path, 'a', encoding='utf8')
+
+    def append(self, op: str, **fields) -> None:
+        record = {
+            key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in fields.items()
+        }
+        self._file.write(json.dumps({'op': op, **record}) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+
+    def rotate(self) -> None:
+        """Set the records aside until the snapshot containing them is written.
+
+        Records of a rotated journal that was not dropped yet, because
+        writing its snapshot failed, are kept in front of the new ones.
+        """
+        self._file.close()
+        if self.rotated_path.exists():
+            with open(self.path, 'rb') as src, open(self.rotated_path, 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+            mode = 'w'
+        else:
+            os.replace(self.path, self.rotated_path)
+            mode = 'a'
+        self._file = open(self.path, mode, encoding='utf8')
+        self.records = 0
+
+    def drop_rotated(self) -> None:
+        """Drop the rotated records, after they got included in a snapshot."""
+        self.rotated_path.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        self._file.close()
+
+    @classmethod
+    def read(cls, path: Path) -> list[dict]:
+        """Return the records of a journal, ignoring an incompletely written one."""
+        records = []
+        if not path.is_file():
+            return records
+        with open(path, encoding='utf8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    LOG.warning('Ignoring truncated journal record %r', line)
+                    break
+                for key in cls.DATETIME_FIELDS.intersection(record):
+                    record[key] = datetime.fromisoformat(record[key])
+                records.append(record)
+        return records
 
 
 @dataclass
@@ -89,6 +892,54 @@ class openQAJob:
     finished_at: datetime | None = None
 
 
+@dataclass
+class openQABuild:
+    """Track the openQA jobs of a build, indexed by their test id
+
+    The number of jobs per result and the latest finish time are kept up
+    to date as jobs change, so jobs must only be updated through the
+    methods of their build. The latest finish time does not go back when
+    a job restarts; the build has a pending job until it finishes again.
+    """
+
+    jobs: dict[str, list[openQAJob]] = field(default_factory=dict)
+    results: collections.Counter = field(default_factory=collections.Counter)
+    last_finished: datetime | None = None
+
+    def __iter__(self):
+        for jobs in self.jobs.values():
+            yield from jobs
+
+    @property
+    def pending(self) -> int:
+        return self.results['pending']
+
+    def add(self, job: openQAJob) -> None:
+        self.jobs.setdefault(job.test_id, []).append(job)
+        self.results[job.result] += 1
+        self._finished(job.finished_at)
+
+    def restart(self, job: openQAJob) -> None:
+        self.results[job.result] -= 1
+        self.results['pending'] += 1
+        job.result = 'pending'
+        job.finished_at = None
+
+    def finish(self, job: openQAJob, result: str, finished_at: datetime) -> None:
+        self.results[job.result] -= 1
+        self.results[result] += 1
+        job.result = result
+        job.finished_at = finished_at
+        self._finished(finished_at)
+
+    def _finished(self, finished_at: datetime | None) -> None:
+        if finished_at and (not self.last_finished or finished_at > self.last_finished):
+            self.last_finished = finished_at
+
+    def find(self, test_id: str) -> list[openQAJob]:
+        return self.jobs.get(test_id, [])
+
+
 @dataclass
 class bs_Request:
     """Track build service requests identified by id"""
@@ -112,116 +963,1163 @@ class repo_publish:
     is_announced: bool = False
 
 
+@dataclass
+class build_failure:
+    """A package build failure waiting to be announced in a digest"""
+
+    package: str
+    repository: str
+    arch: str
+    failed_at: datetime
+
+
+class StateStore(abc.ABC):
+    """Persistence backend for the state tracked by Slacky.
+
+    Slacky reports every state change to append() as a journal operation,
+    has load() restore its state on start and calls compact() to persist
+    the full state now and then.
+    """
+
+    # operations appended since the last compact()
+    records: int = 0
+
+    @abc.abstractmethod
+    def load(self, slacky: 'Slacky') -> None:
+        """Restore the persisted state into slacky."""
+
+    def append(self, op: str, **fields) -> None:
+        pass
+
+    @abc.abstractmethod
+    def compact(self, slacky: 'Slacky') -> None:
+        """Persist the full state now."""
+
+    def snapshot(self, slacky: 'Slacky') -> bool:
+        """Persist the full state from the consumer, False if it was skipped."""
+        self.compact(slacky)
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """Replace the file at path with data, which is either fully there or not."""
+    tmp = path.with_name(f'.{path.name}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # the rename only survives a crash once the directory got synced as well
+    fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+STATE_MAGIC = b'SLKY'
+STATE_HEADER = struct.Struct('>4sH')
+STATE_VERSION = 1
+# STATE_MIGRATIONS[n] upgrades a decoded state document from version n to n + 1
+STATE_MIGRATIONS: dict[int, Callable[[dict], dict]] = {}
+
+
+def _isoformat(value: datetime | None) -> str | None:
+    return value.isoformat() if value else None
+
+
+def _fromisoformat(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value else None
+
+
+def state_document(slacky: 'Slacky') -> dict:
+    """Copy the tracked entities into the document stored by encode_state()
+
+    Entities are stored as arrays of plain values, so the copy shares
+    nothing with the state and the size only depends on what is tracked.
+    """
+    return {
+        'journal_seq': slacky.journal_seq,
+        'openqa_jobs': [
+            [
+                group_id,
+                build,
+                _isoformat(openqa_build.last_finished),
+                [
+                    [job.test_id, job.result, _isoformat(job.finished_at)]
+                    for job in openqa_build
+                ],
+            ]
+            for (group_id, build), openqa_build in slacky.openqa_jobs.items()
+        ],
+        'bs_requests': [
+            [
+                r.id,
+                r.targetproject,
+                r.targetpackage,
+                _isoformat(r.created_at),
+                r.is_announced,
+                r.is_create_announced,
+            ]
+            for r in slacky.bs_requests.values()
+        ],
+        'repo_publishes': [
+            [
+                r.project,
+                r.repository,
+                r.state,
+                _isoformat(r.state_changed),
+                r.is_announced,
+            ]
+            for r in slacky.repo_publishes.values()
+        ],
+        'container_publishes': [
+            [repo_tag, _isoformat(published_at)]
+            for repo_tag, published_at in slacky.container_publishes.items()
+        ],
+    }
+
+
+def encode_state(doc: dict) -> bytes:
+    """Serialize a state_document() into the versioned snapshot format
+
+    A header with a magic and the format version is followed by the zlib
+    compressed JSON document.
+    """
+    payload = json.dumps(doc, separators=(',', ':')).encode()
+    return STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION) + zlib.compress(payload)
+
+
+def decode_state(data: bytes) -> dict:
+    """Return the keyword arguments of Slacky.restore() for encoded state"""
+    magic, version = STATE_HEADER.unpack_from(data)
+    if magic != STATE_MAGIC:
+        raise ValueError('Not a slacky state snapshot')
+    if version > STATE_VERSION:
+        raise ValueError(f'State format {version} is newer than {STATE_VERSION}')
+    doc = json.loads(zlib.decompress(data[STATE_HEADER.size :]))
+    for from_version in range(version, STATE_VERSION):
+        doc = STATE_MIGRATIONS[from_version](doc)
+
+    openqa_jobs = {}
+    for group_id, build, last_finished, jobs in doc['openqa_jobs']:
+        openqa_build = openQABuild()
+        for test_id, result, finished_at in jobs:
+            openqa_build.add(
+                openQAJob(test_id, build, result, _fromisoformat(finished_at))
+            )
+        # does not go back on restarts, so it can't be derived from the jobs
+        openqa_build.last_finished = _fromisoformat(last_finished)
+        openqa_jobs[(group_id, build)] = openqa_build
+    bs_requests = {}
+    for id, project, package, created_at, *announced in doc['bs_requests']:
+        bs_requests[id] = bs_Request(
+            id, project, package, _fromisoformat(created_at), *announced
+        )
+    repo_publishes = {}
+    for project, repository, state, state_changed, announced in doc['repo_publishes']:
+        repo_publishes[f'{project}/{repository}'] = repo_publish(
+            project, repository, state, _fromisoformat(state_changed), announced
+        )
+    return {
+        'openqa_jobs': openqa_jobs,
+        'bs_requests': bs_requests,
+        'repo_publishes': repo_publishes,
+        'container_publishes': {
+            repo_tag: _fromisoformat(published_at)
+            for repo_tag, published_at in doc['container_publishes']
+        },
+        'journal_seq': doc['journal_seq'],
+    }
+
+
+class SnapshotStateStore(StateStore):
+    """Snapshot of the tracked state in the format of encode_state()
+
+    The state document is copied on the consumer thread, encoding and
+    writing it is left to the thread calling write_snapshot().
+    """
+
+    # duration in seconds and size in bytes of the last written snapshot
+    snapshot_duration: float = 0.0
+    snapshot_size: int = 0
+
+    def __init__(self, directory: Path):
+        self.snapshot_file = directory / 'state.snapshot'
+        self.legacy_file = directory / 'state.pickle'
+        self._snapshot_lock = threading.Lock()
+
+    def load(self, slacky: 'Slacky') -> None:
+        if self.snapshot_file.is_file():
+            slacky.restore(**decode_state(self.snapshot_file.read_bytes()))
+        elif self.legacy_file.is_file():
+            self._load_legacy(slacky)
+
+    def _load_legacy(self, slacky: 'Slacky') -> None:
+        # state.pickle holds a pickled Slacky instance of older releases,
+        # which kept a list of jobs per openQA build
+        with open(self.legacy_file, 'rb') as f:
+            data = vars(pickle.load(f))
+        openqa_jobs = {}
+        for qajob, jobs in data.get('openqa_jobs', {}).items():
+            build = openqa_jobs[qajob] = openQABuild()
+            for job in jobs:
+                build.add(job)
+        slacky.restore(
+            openqa_jobs=openqa_jobs,
+            bs_requests=dict(data.get('bs_requests', {})),
+            repo_publishes=dict(data.get('repo_publishes', {})),
+            container_publishes=dict(data.get('container_publishes', {})),
+        )
+        LOG.info('Migrating state from %s', self.legacy_file.name)
+
+    def serialize(self, slacky: 'Slacky') -> dict:
+        """Copy the state for write_snapshot().
+
+        Runs on the consumer thread, so the state does not change while it
+        is being copied. Keep this cheap, encoding the copy is up to
+        write_snapshot() which may run on any thread.
+        """
+        return state_document(slacky)
+
+    def write_snapshot(self, snapshot: dict) -> int:
+        """Persist a copy made by serialize(), returning the size in bytes."""
+        data = encode_state(snapshot)
+        write_atomic(self.snapshot_file, data)
+        self.legacy_file.unlink(missing_ok=True)
+        return len(data)
+
+    def _write_snapshot(self, snapshot: dict) -> None:
+        start = time.perf_counter()
+        self.snapshot_size = self.write_snapshot(snapshot)
+        self.snapshot_duration = time.perf_counter() - start
+        LOG.info(
+            'Saved state snapshot of %d bytes in %.1f ms',
+            self.snapshot_size,
+            self.snapshot_duration * 1000,
+            extra={'bytes': self.snapshot_size, 'duration': self.snapshot_duration},
+        )
+
+    def compact(self, slacky: 'Slacky') -> None:
+        """Persist the full state now, waiting for a snapshot in progress."""
+        with self._snapshot_lock:
+            self._write_snapshot(self.serialize(slacky))
+
+    def snapshot(self, slacky: 'Slacky') -> bool:
+        """Persist the full state on a background thread.
+
+        Returns False without doing anything while the previous snapshot is
+        still being written.
+        """
+        if not self._snapshot_lock.acquire(blocking=False):
+            return False
+        try:
+            snapshot = self.serialize(slacky)
+        except BaseException:
+            self._snapshot_lock.release()
+            raise
+
+        def write() -> None:
+            try:
+                self._write_snapshot(snapshot)
+            except Exception:
+                LOG.exception('Failed to write state snapshot')
+            finally:
+                self._snapshot_lock.release()
+
+        threading.Thread(target=write, name='slacky-snapshot', daemon=True).start()
+        return True
+
+
+class JournalStateStore(SnapshotStateStore):
+    """Snapshot plus a StateJournal of the changes since"""
+
+    def __init__(self, directory: Path, fsync: bool = False):
+        super().__init__(directory)
+        self.journal = StateJournal(directory / 'state.journal', fsync)
+
+    @property
+    def records(self) -> int:
+        return self.journal.records
+
+    def load(self, slacky: 'Slacky') -> None:
+        super().load(slacky)
+        # replay skips the records already contained in the snapshot
+        records = StateJournal.read(self.journal.rotated_path)
+        records += StateJournal.read(self.journal.path)
+        for record in records:
+            slacky.replay(record)
+        if records:
+            LOG.info('Replayed %d journal records', len(records))
+
+    def append(self, op: str, **fields) -> None:
+        self.journal.append(op, **fields)
+
+    def serialize(self, slacky: 'Slacky') -> dict:
+        snapshot = super().serialize(slacky)
+        self.journal.rotate()
+        return snapshot
+
+    def write_snapshot(self, snapshot: dict) -> int:
+        size = super().write_snapshot(snapshot)
+        self.journal.drop_rotated()
+        return size
+
+    def close(self) -> None:
+        self.journal.close()
+
+
+class SQLiteStateStore(StateStore):
+    """SQLite database in WAL mode with a table per tracked entity
+
+    Every operation is applied to the database right away. load() only
+    restores the requests, repositories and containers into memory, the
+    openQA builds are loaded when an event or check looks them up, see
+    StoredBuilds. The deadlines of check_pending_requests() are range
+    queries on the indexed timestamps instead of a heap, see expired().
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS openqa_jobs (
+            group_id INTEGER NOT NULL,
+            build TEXT NOT NULL,
+            test_id TEXT NOT NULL,
+            result TEXT NOT NULL,
+            finished_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS openqa_jobs_test
+            ON openqa_jobs (group_id, build, test_id);
+        CREATE TABLE IF NOT EXISTS openqa_builds (
+            group_id INTEGER NOT NULL,
+            build TEXT NOT NULL,
+            last_finished TEXT,
+            PRIMARY KEY (group_id, build)
+        );
+        CREATE INDEX IF NOT EXISTS openqa_builds_finished
+            ON openqa_builds (last_finished);
+        CREATE TABLE IF NOT EXISTS bs_requests (
+            id INTEGER PRIMARY KEY,
+            targetproject TEXT NOT NULL,
+            targetpackage TEXT,
+            created_at TEXT NOT NULL,
+            is_announced INTEGER NOT NULL DEFAULT 0,
+            is_create_announced INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS bs_requests_hanging
+            ON bs_requests (is_announced, created_at);
+        CREATE INDEX IF NOT EXISTS bs_requests_created
+            ON bs_requests (is_create_announced, created_at);
+        CREATE TABLE IF NOT EXISTS repo_publishes (
+            prjrepo TEXT PRIMARY KEY,
+            project TEXT NOT NULL,
+            repository TEXT NOT NULL,
+            state TEXT NOT NULL,
+            state_changed TEXT NOT NULL,
+            is_announced INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS repo_publishes_hanging
+            ON repo_publishes (is_announced, state_changed);
+        CREATE TABLE IF NOT EXISTS container_publishes (
+            repo_tag TEXT PRIMARY KEY,
+            published_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS container_publishes_published
+            ON container_publishes (published_at);
+    """
+
+    def __init__(self, path: Path, cached_builds: int = 1000):
+        self.path = path
+        self.cached_builds = cached_builds
+        # the metrics endpoint counts the tracked builds from its own thread
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+        self.records = 0
+
+    @staticmethod
+    def _datetime(value: str | None) -> datetime | None:
+        return datetime.fromisoformat(value) if value else None
+
+    def load(self, slacky: 'Slacky') -> None:
+        bs_requests = {}
+        for row in self.db.execute('SELECT * FROM bs_requests ORDER BY id'):
+            bs_requests[row['id']] = bs_Request(
+                row['id'],
+                row['targetproject'],
+                row['targetpackage'],
+                self._datetime(row['created_at']),
+                bool(row['is_announced']),
+                bool(row['is_create_announced']),
+            )
+        repo_publishes = {}
+        for row in self.db.execute('SELECT * FROM repo_publishes'):
+            repo_publishes[row['prjrepo']] = repo_publish(
+                row['project'],
+                row['repository'],
+                row['state'],
+                self._datetime(row['state_changed']),
+                bool(row['is_announced']),
+            )
+        container_publishes = {
+            repo_tag: self._datetime(published_at)
+            for repo_tag, published_at in self.db.execute(
+                'SELECT repo_tag, published_at FROM container_publishes'
+            )
+        }
+        slacky.restore(
+            openqa_jobs=StoredBuilds(self, self.cached_builds),
+            bs_requests=bs_requests,
+            repo_publishes=repo_publishes,
+            container_publishes=container_publishes,
+            deadlines=StoredDeadlines(self),
+        )
+        LOG.info('Loaded state from %s', self.path.name)
+
+    def load_build(self, key: tuple[int, str]) -> openQABuild | None:
+        """Read the openQA build with key (group_id, build) from the database."""
+        row = self.db.execute(
+            'SELECT last_finished FROM openqa_builds WHERE group_id = ? AND build = ?',
+            key,
+        ).fetchone()
+        if row is None:
+            return None
+        openqa_build = openQABuild()
+        for test_id, result, finished_at in self.db.execute(
+            'SELECT test_id, result, finished_at FROM openqa_jobs'
+            ' WHERE group_id = ? AND build = ? ORDER BY rowid',
+            key,
+        ):
+            openqa_build.add(
+                openQAJob(test_id, key[1], result, self._datetime(finished_at))
+            )
+        # does not go back on restarts, so it can't be derived from the jobs
+        openqa_build.last_finished = self._datetime(row['last_finished'])
+        return openqa_build
+
+    def build_keys(self) -> list[tuple[int, str]]:
+        return [
+            (group_id, build)
+            for group_id, build in self.db.execute(
+                'SELECT group_id, build FROM openqa_builds'
+            )
+        ]
+
+    def count_builds(self) -> int:
+        return self.db.execute('SELECT count(*) FROM openqa_builds').fetchone()[0]
+
+    def expired(self, now: datetime) -> collections.defaultdict[str, dict]:
+        """Return {kind: {key: deadline}} for the deadlines before now.
+
+        Unlike DeadlineScheduler.pop_expired(), an item is returned by every
+        call until check_pending_requests() changed the state it is due for.
+        Items expired for longer than check_pending_requests() cares about
+        are left out.
+        """
+        expired = collections.defaultdict(dict)
+        # kind, delay after the timestamp, how long it stays expired, query
+        # selecting the key and timestamp of items expired between since and due
+        for kind, delay, window, query in (
+            (
+                'request_hanging',
+                HANGING_REQUESTS,
+                None,
+                'SELECT id, created_at FROM bs_requests'
+                ' WHERE is_announced = 0 AND created_at < :due',
+            ),
+            (
+                'request_created',
+                timedelta(seconds=60),
+                HANGING_REQUESTS - timedelta(seconds=60),
+                'SELECT id, created_at FROM bs_requests WHERE is_create_announced = 0'
+                ' AND created_at < :due AND created_at > :since',
+            ),
+            (
+                'repo_publish',
+                HANGING_REPO_PUBLISH,
+                None,
+                'SELECT prjrepo, state_changed FROM repo_publishes'
+                ' WHERE is_announced = 0 AND state_changed < :due',
+            ),
+            (
+                'container',
+                HANGING_CONTAINER_TAG,
+                timedelta(hours=2),
+                'SELECT repo_tag, published_at FROM container_publishes'
+                ' WHERE published_at < :due AND published_at > :since',
+            ),
+            (
+                # builds with pending jobs are due once those finished
+                'openqa',
+                OPENQA_FAIL_WAIT,
+                None,
+                'SELECT group_id, build, last_finished FROM openqa_builds AS b'
+                ' WHERE last_finished < :due AND NOT EXISTS (SELECT 1'
+                ' FROM openqa_jobs AS j WHERE j.group_id = b.group_id'
+                " AND j.build = b.build AND j.result = 'pending')",
+            ),
+        ):
+            due = now - delay
+            params = {'due': due.isoformat()}
+            if window is not None:
+                params['since'] = (due - window).isoformat()
+            for *key, timestamp in self.db.execute(query, params):
+                key = tuple(key) if len(key) > 1 else key[0]
+                expired[kind][key] = self._datetime(timestamp) + delay
+        return expired
+
+    def append(self, op: str, seq: int = 0, **fields) -> None:
+        for key, value in fields.items():
+            if isinstance(value, datetime):
+                fields[key] = value.isoformat()
+        with self.db:
+            match op:
+                case 'request_created':
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO bs_requests (id, targetproject,'
+                        ' targetpackage, created_at) VALUES (:id, :targetproject,'
+                        ' :targetpackage, :created_at)',
+                        fields,
+                    )
+                case 'request_closed':
+                    self.db.execute('DELETE FROM bs_requests WHERE id = :id', fields)
+                case 'request_announced':
+                    self.db.executemany(
+                        'UPDATE bs_requests SET is_create_announced = 1'
+                        + ('' if fields['create_only'] else ', is_announced = 1')
+                        + ' WHERE id = ?',
+                        ((id,) for id in fields['ids']),
+                    )
+                case 'job_created':
+                    self.db.execute(
+                        'INSERT INTO openqa_jobs (group_id, build, test_id, result)'
+                        " VALUES (:group_id, :build, :test_id, 'pending')",
+                        fields,
+                    )
+                    self.db.execute(
+                        'INSERT OR IGNORE INTO openqa_builds (group_id, build)'
+                        ' VALUES (:group_id, :build)',
+                        fields,
+                    )
+                case 'job_restarted':
+                    self.db.execute(
+                        "UPDATE openqa_jobs SET result = 'pending', finished_at = NULL"
+                        ' WHERE rowid = (SELECT min(rowid) FROM openqa_jobs'
+                        ' WHERE group_id = :group_id AND build = :build'
+                        ' AND test_id = :test_id)',
+                        fields,
+                    )
+                case 'job_finished':
+                    self.db.execute(
+                        'UPDATE openqa_jobs SET result = :result,'
+                        ' finished_at = :finished_at WHERE group_id = :group_id'
+                        ' AND build = :build AND test_id = :test_id',
+                        fields,
+                    )
+                    self.db.execute(
+                        'UPDATE openqa_builds SET last_finished ='
+                        ' max(coalesce(last_finished, :finished_at), :finished_at)'
+                        ' WHERE group_id = :group_id AND build = :build',
+                        fields,
+                    )
+                case 'build_closed':
+                    for table in ('openqa_jobs', 'openqa_builds'):
+                        self.db.execute(
+                            f'DELETE FROM {table}'
+                            ' WHERE group_id = :group_id AND build = :build',
+                            fields,
+                        )
+                case 'repo_state':
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO repo_publishes (prjrepo, project,'
+                        " repository, state, state_changed) VALUES (:project || '/'"
+                        ' || :repository, :project, :repository, :state,'
+                        ' :state_changed)',
+                        fields,
+                    )
+                case 'repo_published':
+                    self.db.execute(
+                        'DELETE FROM repo_publishes WHERE prjrepo = :prjrepo', fields
+                    )
+                case 'repo_announced':
+                    self.db.execute(
+                        'UPDATE repo_publishes SET is_announced = 1'
+                        ' WHERE prjrepo = :prjrepo',
+                        fields,
+                    )
+                case 'container_published':
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO container_publishes'
+                        ' (repo_tag, published_at) VALUES (:repo_tag, :published_at)',
+                        fields,
+                    )
+                case 'container_announced':
+                    self.db.executemany(
+                        'DELETE FROM container_publishes WHERE repo_tag = ?',
+                        ((repo_tag,) for repo_tag in fields['repo_tags']),
+                    )
+                case _:
+                    raise ValueError(f'Unknown state operation {op!r}')
+        self.records += 1
+
+    def compact(self, slacky: 'Slacky') -> None:
+        # everything is stored already, just fold the WAL back into the database
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.records = 0
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class StoredBuilds(MutableMapping):
+    """The openQA builds of a SQLiteStateStore, loaded when looked up
+
+    Only the cache_size builds used last are kept in memory. Slacky writes
+    every change to the store as it makes it, so an evicted build is read
+    back as it was. Iterating reads all keys from the database.
+    """
+
+    def __init__(self, store: SQLiteStateStore, cache_size: int = 1000):
+        self.store = store
+        self.cache_size = cache_size
+        self._cache: collections.OrderedDict[tuple[int, str], openQABuild] = (
+            collections.OrderedDict()
+        )
+
+    def __getitem__(self, key: tuple[int, str]) -> openQABuild:
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        openqa_build = self.store.load_build(key)
+        if openqa_build is None:
+            raise KeyError(key)
+        self[key] = openqa_build
+        return openqa_build
+
+    def __setitem__(self, key: tuple[int, str], openqa_build: openQABuild) -> None:
+        self._cache[key] = openqa_build
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def __delitem__(self, key: tuple[int, str]) -> None:
+        # the build_closed operation deleted it from the store already
+        self._cache.pop(key, None)
+
+    def __iter__(self):
+        return iter(self.store.build_keys())
+
+    def __len__(self) -> int:
+        return self.store.count_builds()
+
+
+class StoredDeadlines(DeadlineScheduler):
+    """Deadlines of the items in a SQLiteStateStore, see its expired()
+
+    They are derived from the stored timestamps, so scheduling does nothing.
+    """
+
+    def __init__(self, store: SQLiteStateStore):
+        super().__init__()
+        self.store = store
+
+    def schedule(self, deadline: datetime, kind: str, key) -> None:
+        pass
+
+    def schedule_once(self, deadline: datetime, kind: str, key) -> None:
+        pass
+
+    def pop_expired(self, now: datetime) -> collections.defaultdict[str, dict]:
+        return self.store.expired(now)
+
+
+def open_state_store(conf) -> StateStore:
+    """Create the state store configured with state_store in the DEFAULT section."""
+    directory = Path(conf.get('state_dir', str(STATE_DIR)))
+    match conf.get('state_store', 'journal'):
+        # pickle is what the snapshot only store was called before
+        case 'snapshot' | 'pickle':
+            return SnapshotStateStore(directory)
+        case 'journal':
+            return JournalStateStore(directory, conf.getboolean('journal_fsync', False))
+        case 'sqlite':
+            return SQLiteStateStore(
+                directory / 'state.sqlite', conf.getint('sqlite_cached_builds', 1000)
+            )
+        case backend:
+            raise ValueError(f'Unknown state store {backend!r}')
+
+
+@dataclass
+class SlackyState:
+    """Everything tracked by one Slacky instance
+
+    The indexes and deadlines are kept in sync with the tracked entities
+    by Slacky, so only change the state through its methods.
+    """
+
+    # when adding more state, please update state_document(), decode_state(),
+    # schedule_deadlines() and replay(), and change it only in methods of
+    # Slacky that write to the journal
+    openqa_jobs: dict[tuple[int, str], openQABuild] = field(default_factory=dict)
+    bs_requests: dict[int, bs_Request] = field(default_factory=dict)
+    # ids of the tracked bs_requests per target project
+    requests_by_project: dict[str, set[int]] = field(default_factory=dict)
+    repo_publishes: dict[str, repo_publish] = field(default_factory=dict)
+    container_publishes: dict[str, datetime] = field(default_factory=dict)
+    # build failures per project, announced together after build_fail_window
+    build_failures: dict[str, list[build_failure]] = field(default_factory=dict)
+    deadlines: DeadlineScheduler = field(default_factory=DeadlineScheduler)
+    # sequence number of the last journal record included in the state
+    journal_seq: int = 0
+
+
+def _state_attribute(name: str) -> property:
+    """Read-only property forwarding to the SlackyState attribute name
+
+    Replacing the state goes through Slacky.restore(), which keeps the
+    indexes and deadlines in sync.
+    """
+    return property(lambda self: getattr(self.state, name), doc=f'state.{name}')
+
+
 class Slacky:
-    # when adding more state, please update load_state()
-    openqa_jobs = collections.defaultdict(list)
-    bs_requests = collections.defaultdict(None)
-    repo_publishes: dict = {}
-    container_publishes: dict = {}
-    last_interval_check: datetime = datetime.now()
+    check_interval: timedelta = timedelta(seconds=120)
+    last_check_duration: float = 0.0
+    journal_compact_records: int = 10000
+    snapshot_interval: timedelta = timedelta(seconds=300)
+    is_setup: bool = False
+    # started by SIGUSR1, profiles the consumer for profile_seconds
+    profiler: cProfile.Profile | None = None
+    profile_seconds: float = 30
+    profile_dir: Path = STATE_DIR
+    # call_later() of the current consumer, set by start_timers() and reset
+    # once the consumer is gone
+    call_later: Callable[[float, Callable], object] | None = None
+    # time.monotonic() at which the running profiler stops
+    profile_until: float = 0.0
+    build_fail_window: timedelta = timedelta(seconds=60)
+    slack_session: SlackSession | None = None
+    # how long to wait for queued slack notifications on shutdown
+    outbox_stop_timeout: float = 30
+
+    openqa_jobs = _state_attribute('openqa_jobs')
+    bs_requests = _state_attribute('bs_requests')
+    requests_by_project = _state_attribute('requests_by_project')
+    repo_publishes = _state_attribute('repo_publishes')
+    container_publishes = _state_attribute('container_publishes')
+    build_failures = _state_attribute('build_failures')
+    deadlines = _state_attribute('deadlines')
+    journal_seq = _state_attribute('journal_seq')
+
+    def __init__(self, state: SlackyState | None = None):
+        self.state = state if state is not None else SlackyState()
+        self.store: StateStore | None = None
+        self.consumer_lag = LagTracker('Consumer')
+
+    def _index_requests(self) -> None:
+        self.state.requests_by_project = {}
+        for bs_request in self.state.bs_requests.values():
+            self.requests_by_project.setdefault(bs_request.targetproject, set()).add(
+                bs_request.id
+            )
+
+    def add_request(self, bs_request: bs_Request) -> None:
+        """Track a build service request for hang detection."""
+        self._journal(
+            'request_created',
+            id=bs_request.id,
+            targetproject=bs_request.targetproject,
+            targetpackage=bs_request.targetpackage,
+            created_at=bs_request.created_at,
+        )
+        self.state.bs_requests[bs_request.id] = bs_request
+        self.requests_by_project.setdefault(bs_request.targetproject, set()).add(
+            bs_request.id
+        )
+        self._schedule_request(bs_request)
+
+    def remove_request(self, id: int) -> None:
+        """Stop tracking a build service request."""
+        self._journal('request_closed', id=id)
+        bs_request = self.state.bs_requests.pop(id)
+        ids = self.requests_by_project[bs_request.targetproject]
+        ids.discard(id)
+        if not ids:
+            del self.requests_by_project[bs_request.targetproject]
+
+    def project_requests(self, project: str) -> list[bs_Request]:
+        return [
+            self.state.bs_requests[id]
+            for id in self.requests_by_project.get(project, ())
+        ]
+
+    def schedule_deadlines(self) -> None:
+        """Register the deadlines of all tracked state with the scheduler."""
+        self.deadlines.clear()
+        if isinstance(self.deadlines, StoredDeadlines):
+            # derived from the state in the store, and its builds are not loaded
+            return
+        for bs_request in self.bs_requests.values():
+            self._schedule_request(bs_request)
+        for prjrepo, repo in self.repo_publishes.items():
+            if not repo.is_announced:
+                self.deadlines.schedule_once(
+                    repo.state_changed + HANGING_REPO_PUBLISH, 'repo_publish', prjrepo
+                )
+        for repo_tag, publishdate in self.container_publishes.items():
+            self.deadlines.schedule_once(
+                publishdate + HANGING_CONTAINER_TAG, 'container', repo_tag
+            )
+        for qajob, build in self.openqa_jobs.items():
+            if build.last_finished:
+                self.deadlines.schedule_once(
+                    build.last_finished + OPENQA_FAIL_WAIT, 'openqa', qajob
+                )
+
+    def _schedule_request(self, bs_request: bs_Request) -> None:
+        if not bs_request.is_announced:
+            self.deadlines.schedule(
+                bs_request.created_at + HANGING_REQUESTS,
+                'request_hanging',
+                bs_request.id,
+            )
+        if not bs_request.is_create_announced:
+            # announced once no further request came in for a minute
+            self.deadlines.schedule(
+                bs_request.created_at + timedelta(seconds=60),
+                'request_created',
+                bs_request.id,
+            )
+
+    def _journal(self, op: str, **fields) -> None:
+        if self.store is not None:
+            self.state.journal_seq += 1
+            self.store.append(op, seq=self.journal_seq, **fields)
+
+    def mark_requests_announced(self, ids: list[int], create_only: bool) -> None:
+        self._journal('request_announced', ids=ids, create_only=create_only)
+        for id in ids:
+            bs_request = self.state.bs_requests[id]
+            bs_request.is_create_announced = True
+            if not create_only:
+                bs_request.is_announced = True
+
+    def create_openqa_job(self, group_id: int, build: str, test_id: str) -> None:
+        # looked up first, a build loaded from the store would have the job
+        openqa_build = self.openqa_jobs.get((group_id, build))
+        self._journal('job_created', group_id=group_id, build=build, test_id=test_id)
+        if openqa_build is None:
+            openqa_build = self.openqa_jobs[(group_id, build)] = openQABuild()
+        openqa_build.add(openQAJob(test_id=test_id, build=build, result='pending'))
+
+    def restart_openqa_job(self, group_id: int, build: str, test_id: str) -> bool:
+        """Set the first job with test_id to pending, False if there is none."""
+        openqa_build = self.openqa_jobs.get((group_id, build))
+        for job in openqa_build.find(test_id) if openqa_build else ():
+            self._journal(
+                'job_restarted', group_id=group_id, build=build, test_id=test_id
+            )
+            openqa_build.restart(job)
+            return True
+        return False
+
+    def finish_openqa_job(
+        self,
+        group_id: int,
+        build: str,
+        test_id: str,
+        result: str,
+        finished_at: datetime,
+    ) -> None:
+        openqa_build = self.openqa_jobs.get((group_id, build))
+        jobs = openqa_build.find(test_id) if openqa_build else []
+        if not jobs:
+            return
+        self._journal(
+            'job_finished',
+            group_id=group_id,
+            build=build,
+            test_id=test_id,
+            result=result,
+            finished_at=finished_at,
+        )
+        for job in jobs:
+            openqa_build.finish(job, result, finished_at)
+        # moved to the latest finish time once the entry expires
+        self.deadlines.schedule_once(
+            openqa_build.last_finished + OPENQA_FAIL_WAIT, 'openqa', (group_id, build)
+        )
+
+    def close_openqa_build(self, group_id: int, build: str) -> None:
+        self._journal('build_closed', group_id=group_id, build=build)
+        del self.openqa_jobs[(group_id, build)]
+
+    def set_repo_state(
+        self, project: str, repository: str, state: str, state_changed: datetime
+    ) -> None:
+        self._journal(
+            'repo_state',
+            project=project,
+            repository=repository,
+            state=state,
+            state_changed=state_changed,
+        )
+        prjrepo = f'{project}/{repository}'
+        self.repo_publishes[prjrepo] = repo_publish(
+            project=project,
+            repository=repository,
+            state=state,
+            state_changed=state_changed,
+        )
+        # moved to the latest state change once the entry expires
+        self.deadlines.schedule_once(
+            state_changed + HANGING_REPO_PUBLISH, 'repo_publish', prjrepo
+        )
+
+    def remove_repo(self, prjrepo: str) -> None:
+        if prjrepo in self.repo_publishes:
+            self._journal('repo_published', prjrepo=prjrepo)
+            del self.repo_publishes[prjrepo]
+
+    def mark_repo_announced(self, prjrepo: str) -> None:
+        self._journal('repo_announced', prjrepo=prjrepo)
+        self.repo_publishes[prjrepo].is_announced = True
+
+    def add_container_publish(self, repo_tag: str, published_at: datetime) -> None:
+        self._journal(
+            'container_published', repo_tag=repo_tag, published_at=published_at
+        )
+        self.container_publishes[repo_tag] = published_at
+        # moved to the latest publish once the entry expires
+        self.deadlines.schedule_once(
+            published_at + HANGING_CONTAINER_TAG, 'container', repo_tag
+        )
+
+    def remove_container_publishes(self, repo_tags: list[str]) -> None:
+        self._journal('container_announced', repo_tags=repo_tags)
+        for repo_tag in repo_tags:
+            self.container_publishes.pop(repo_tag)
+
+    def replay(self, record: dict) -> None:
+        """Apply a journal record to the state, the inverse of _journal()."""
+        fields = dict(record)
+        seq = fields.pop('seq', 0)
+        if seq <= self.journal_seq:
+            # already part of the snapshot
+            return
+        self.state.journal_seq = seq
+        match fields.pop('op'):
+            case 'request_created':
+                self.add_request(bs_Request(**fields))
+            case 'request_closed':
+                self.remove_request(**fields)
+            case 'request_announced':
+                self.mark_requests_announced(**fields)
+            case 'job_created':
+                self.create_openqa_job(**fields)
+            case 'job_restarted':
+                self.restart_openqa_job(**fields)
+            case 'job_finished':
+                self.finish_openqa_job(**fields)
+            case 'build_closed':
+                self.close_openqa_build(**fields)
+            case 'repo_state':
+                self.set_repo_state(**fields)
+            case 'repo_published':
+                self.remove_repo(**fields)
+            case 'repo_announced':
+                self.mark_repo_announced(**fields)
+            case 'container_published':
+                self.add_container_publish(**fields)
+            case 'container_announced':
+                self.remove_container_publishes(**fields)
+            case op:
+                LOG.warning('Ignoring unknown journal record %r', op)
 
     def handle_openqa_event(self, routing_key, body):
         """Find failed jobs without pending jobs and then post a message to slack."""
-        msg = json.loads(body)
-        if msg.get('group_id') not in OPENQA_GROUPS_FILTER:
-            return
+        group_id = peek_json_field(body, 'group_id')
+        if group_id is not UNCERTAIN and group_id not in OPENQA_GROUPS_FILTER:
+            return False
 
-        build_id: str = msg.get('BUILD')
-        qajob: tuple[int, str] = (msg['group_id'], build_id)
-        test_id: str = f"{msg.get('TEST')}/{msg.get('ARCH')}"
+        msg = decode_event(openQAJobEvent, body)
+        if msg.group_id not in OPENQA_GROUPS_FILTER:
+            return False
 
-        def find_test_id(job):
-            return job.test_id == test_id
+        build_id: str = msg.BUILD
+        qajob: tuple[int, str] = (msg.group_id, build_id)
+        test_id: str = f'{msg.TEST}/{msg.ARCH}'
 
-        LOG.debug(f' [x] {routing_key!r}:{msg!r}')
+        LOG.debug(' [x] %r:%r', routing_key, msg)
+        extra = {
+            'routing_key': routing_key,
+            'group_id': msg.group_id,
+            'build': build_id,
+            'test': test_id,
+        }
         if 'suse.openqa.job.create' in routing_key:
-            self.openqa_jobs[qajob].append(
-                openQAJob(test_id=test_id, build=build_id, result='pending')
-            )
-            LOG.info(f'Job {qajob}/{test_id} created (pending)')
+            self.create_openqa_job(msg.group_id, build_id, test_id)
+            LOG.info('Job %s/%s created (pending)', qajob, test_id, extra=extra)
         if 'suse.openqa.job.restart' in routing_key:
-            for job in filter(find_test_id, self.openqa_jobs[qajob]):
-                job.result = 'pending'
-                job.finished_at = None
-                LOG.info(f'Job {qajob}/{test_id} restarted and stored as (pending)')
-                break
+            if self.restart_openqa_job(msg.group_id, build_id, test_id):
+                LOG.info(
+                    'Job %s/%s restarted and stored as (pending)',
+                    qajob,
+                    test_id,
+                    extra=extra,
+                )
             else:
-                LOG.info(f'Ignored restart on {qajob}/{test_id}')
+                LOG.info('Ignored restart on %s/%s', qajob, test_id, extra=extra)
         elif 'suse.openqa.job.done' in routing_key:
-            for job in filter(find_test_id, self.openqa_jobs[qajob]):
-                if msg.get('reason') is not None:
-                    LOG.info(f'Job {qajob}/{test_id} is going to restart')
-                    continue
-                job.result = msg['result']
-                job.finished_at = datetime.now()
+            if msg.reason is not None:
+                LOG.info('Job %s/%s is going to restart', qajob, test_id, extra=extra)
+                return True
+            self.finish_openqa_job(
+                msg.group_id, build_id, test_id, msg.result, datetime.now()
+            )
+        return True
 
     def handle_obs_package_event(self, routing_key, body):
         """Post any build failures for the configured projects to slack."""
-        msg = json.loads(body)
+        if not self.may_match(self.project_re, body):
+            return False
 
-        if (
-            not self.project_re.match(msg.get('project', ''))
-            or msg.get('previouslyfailed') == '1'
-        ):
-            return
+        msg = decode_event(obsPackageEvent, body)
+
+        if not self.project_re.match(msg.project) or msg.previouslyfailed == '1':
+            return False
 
         if 'suse.obs.package.build_fail' in routing_key:
             LOG.info(
-                f"obs build fail {msg['project']}/{msg['package']}/{msg['repository']}/{msg['arch']}"
+                'obs build fail %s/%s/%s/%s',
+                msg.project,
+                msg.package,
+                msg.repository,
+                msg.arch,
+                extra={
+                    'routing_key': routing_key,
+                    'project': msg.project,
+                    'package': msg.package,
+                },
+            )
+            self.build_failures.setdefault(msg.project, []).append(
+                build_failure(
+                    package=msg.package,
+                    repository=msg.repository,
+                    arch=msg.arch,
+                    failed_at=datetime.now(),
+                )
             )
+            if not self.build_fail_window:
+                self.flush_build_failures(force=True)
+        return True
+
+    def flush_build_failures(self, force: bool = False) -> None:
+        """Announce the build failures of every project whose window has passed."""
+        now = datetime.now()
+        for prj, failures in list(self.build_failures.items()):
+            if not force and failures[0].failed_at + self.build_fail_window > now:
+                continue
+            del self.build_failures[prj]
+            if len(failures) == 1:
+                fail = failures[0]
+                post_failure_notification_to_slack(
+                    ':obs:',
+                    f'{prj}/{fail.package}/{fail.repository}/{fail.arch} failed to build.',
+                    urllib.parse.urljoin(
+                        CONF['obs']['host'],
+                        f'/package/live_build_log/{prj}/{fail.package}/{fail.repository}/{fail.arch}',
+                    ),
+                )
+                continue
+
+            archs = collections.Counter(fail.arch for fail in failures)
+            pkgs = sorted({fail.package for fail in failures})
+            if len(pkgs) > BUILD_FAIL_DIGEST_PACKAGES:
+                pkgs[BUILD_FAIL_DIGEST_PACKAGES:] = [
+                    f'{len(pkgs) - BUILD_FAIL_DIGEST_PACKAGES} more'
+                ]
             post_failure_notification_to_slack(
                 ':obs:',
-                f"{msg['project']}/{msg['package']}/{msg['repository']}/{msg['arch']} failed to build.",
+                f'{len(failures)} builds failed in {prj} '
+                f'({", ".join(f"{arch}: {count}" for arch, count in sorted(archs.items()))}): '
+                f'{", ".join(pkgs)}',
                 urllib.parse.urljoin(
-                    CONF['obs']['host'],
-                    f"/package/live_build_log/{msg['project']}/{msg['package']}/{msg['repository']}/{msg['arch']}",
+                    CONF['obs']['host'], f'/project/monitor/{prj}?failed=1'
                 ),
             )
 
     def handle_obs_repo_event(self, routing_key, body):
         """Post any build failures for the configured projects to slack."""
-        msg = json.loads(body)
+        if not self.may_match(self.repo_re, body):
+            return False
 
-        if not self.repo_re.match(msg.get('project')) or not msg.get('state'):
-            return
+        msg = decode_event(obsRepoEvent, body)
 
-        prjrepo = f"{msg['project']}/{msg['repo']}"
-        LOG.info(f'repo event for {prjrepo}: {msg}')
-        if msg['state'] == 'published':
-            if prjrepo in self.repo_publishes:
-                del self.repo_publishes[prjrepo]
-            return
+        if not self.repo_re.match(msg.project) or not msg.state:
+            return False
 
-        self.repo_publishes[prjrepo] = repo_publish(
-            project=msg['project'],
-            repository=msg['repo'],
-            state=msg['state'],
-            state_changed=datetime.now(),
+        prjrepo = f'{msg.project}/{msg.repo}'
+        LOG.info(
+            'repo event for %s: %s',
+            prjrepo,
+            msg,
+            extra={
+                'routing_key': routing_key,
+                'project': msg.project,
+                'repo': msg.repo,
+            },
         )
+        if msg.state == 'published':
+            self.remove_repo(prjrepo)
+            return True
+
+        self.set_repo_state(msg.project, msg.repo, msg.state, datetime.now())
+        return True
 
     def handle_obs_request_event(self, routing_key, body):
         """Warn when requests get declined, track them for hang detection."""
-        msg = json.loads(body)
+        if 'suse.obs.request.create' in routing_key:
+            if ('BCI' if isinstance(body, str) else b'BCI') not in body:
+                return False
+        else:
+            number = peek_json_field(body, 'number')
+            if number is not UNCERTAIN and number not in self.bs_requests:
+                return False
+
+        msg = decode_event(obsRequestEvent, body)
 
         if 'suse.obs.request.create' in routing_key:
-            for action in msg['actions']:
-                if action['type'] == 'submit' and 'BCI' in action['targetproject']:
+            for action in msg.actions:
+                if action.type == 'submit' and 'BCI' in action.targetproject:
                     LOG.info(
-                        f"found new submitrequest against {action['targetproject']}: id {msg['number']}"
+                        'found new submitrequest against %s: id %s',
+                        action.targetproject,
+                        msg.number,
+                        extra={
+                            'routing_key': routing_key,
+                            'project': action.targetproject,
+                            'request_id': msg.number,
+                        },
                     )
                     bs_request = bs_Request(
-                        id=msg['number'],
-                        targetproject=action['targetproject'],
-                        targetpackage=action['targetpackage'],
+                        id=msg.number,
+                        targetproject=action.targetproject,
+                        targetpackage=action.targetpackage,
                         created_at=datetime.now(),
                     )
-                    self.bs_requests[msg['number']] = bs_request
+                    self.add_request(bs_request)
 
         if 'suse.obs.request.state_change' in routing_key:
-            bs_request = self.bs_requests.get(msg['number'])
+            bs_request = self.bs_requests.get(msg.number)
             if bs_request:
-                bs_request.state = msg['state']
-                if msg['state'] in ('declined',):
+                bs_request.state = msg.state
+                if msg.state in ('declined',):
                     post_failure_notification_to_slack(
                         ':request-changes:',
                         f'Request to {bs_request.targetproject} / {bs_request.targetpackage} got declined.',
@@ -229,53 +2127,65 @@ class Slacky:
                             CONF['obs']['host'], f'/request/show/{bs_request.id}'
                         ),
                     )
-                    bs_request.is_announced = True
-                    bs_request.is_create_announced = True
-                if msg['state'] in ('accepted', 'revoked', 'superseded'):
-                    LOG.info(f"request {msg['number']} entered final state.")
-                    del self.bs_requests[msg['number']]
+                    self.mark_requests_announced([bs_request.id], create_only=False)
+                if msg.state in ('accepted', 'revoked', 'superseded'):
+                    LOG.info(
+                        'request %s entered final state.',
+                        msg.number,
+                        extra={'routing_key': routing_key, 'request_id': msg.number},
+                    )
+                    self.remove_request(msg.number)
+        return True
 
     def handle_container_event(self, routing_key, body):
         """Warn when a :latest tag didn't get published a long while."""
-        msg = json.loads(body)
+        if not self.may_match(self.repo_re, body):
+            return False
+
+        msg = decode_event(obsContainerEvent, body)
 
         if 'suse.obs.container.published' in routing_key:
-            if not msg.get('container') or not self.repo_re.match(
-                msg.get('project', '')
-            ):
-                return
+            if not msg.container or not self.repo_re.match(msg.project):
+                return False
 
-            repository, _, tag = msg['container'].partition(':')
+            repository, _, tag = msg.container.partition(':')
             tag_version = tag.rpartition('-')[0] if '-' in tag else tag
             if tag_version.count('.') >= 2:
-                return
+                return False
             if 'registry.suse.com' not in repository:
-                return
+                return False
 
             repo_tag: str = f'{repository.partition("/")[2]}:{tag_version}'
-            LOG.info(f'Container {repo_tag} published.')
-            self.container_publishes[repo_tag] = datetime.now()
+            LOG.info(
+                'Container %s published.',
+                repo_tag,
+                extra={'routing_key': routing_key, 'container': repo_tag},
+            )
+            self.add_container_publish(repo_tag, datetime.now())
+        return True
+
+    @staticmethod
+    def may_match(project_re: re.Pattern, body) -> bool:
+        """Pre-filter raw events on their project before doing a full parse."""
+        project = peek_json_field(body, 'project')
+        return not isinstance(project, str) or project_re.match(project) is not None
 
     def check_pending_requests(self):
         """Announce for things that are hanging around"""
+        now = datetime.now()
+        expired = self.deadlines.pop_expired(now)
 
         # Announce request that are open for a long time
         for prj, reqcount in collections.Counter(
             (
                 req.targetproject
-                for req in self.bs_requests.values()
-                if (
-                    not req.is_announced
-                    and (req.created_at + HANGING_REQUESTS) < datetime.now()
-                )
+                for req in map(self.bs_requests.get, expired['request_hanging'])
+                if req and not req.is_announced
             )
         ).most_common():
-            pkgs = set()
-            for req in self.bs_requests.values():
-                if req.targetproject == prj and not req.is_announced:
-                    pkgs.add(req.targetpackage)
-                    req.is_announced = True
-                    req.is_create_announced = True
+            reqs = [req for req in self.project_requests(prj) if not req.is_announced]
+            pkgs = {req.targetpackage for req in reqs}
+            self.mark_requests_announced([req.id for req in reqs], create_only=False)
             post_failure_notification_to_slack(
                 ':request-changes:',
                 f'{reqcount} hanging requests to {prj} / {", ".join(sorted(pkgs))} '
@@ -285,29 +2195,25 @@ class Slacky:
             )
 
         # Announce requests that have been recently created
-        for prj, reqcount in collections.Counter(
-            (
-                req.targetproject
-                for req in self.bs_requests.values()
-                if not req.is_create_announced
+        created = {}
+        for prj in {
+            req.targetproject
+            for req in map(self.bs_requests.get, expired['request_created'])
+            if req and not req.is_create_announced
+        }:
+            created[prj] = [
+                req for req in self.project_requests(prj) if not req.is_create_announced
+            ]
+        for prj, reqs in sorted(created.items(), key=lambda item: -len(item[1])):
+            reqcount = len(reqs)
+            newest_request_age: float = min(
+                HANGING_REQUESTS.total_seconds(),
+                (now - max(req.created_at for req in reqs)).total_seconds(),
             )
-        ).most_common():
-            newest_request_age: int = HANGING_REQUESTS.total_seconds()
-            for req in self.bs_requests.values():
-                if req.targetproject == prj and not req.is_create_announced:
-                    if (
-                        datetime.now() - req.created_at
-                    ).total_seconds() < newest_request_age:
-                        newest_request_age = (
-                            datetime.now() - req.created_at
-                        ).total_seconds()
             # If we haven't seen a new request in a while, time to announce
             if 60 < newest_request_age < HANGING_REQUESTS.total_seconds():
-                pkgs = set()
-                for req in self.bs_requests.values():
-                    if req.targetproject == prj and not req.is_create_announced:
-                        pkgs.add(req.targetpackage)
-                        req.is_create_announced = True
+                pkgs = {req.targetpackage for req in reqs}
+                self.mark_requests_announced([req.id for req in reqs], create_only=True)
                 post_failure_notification_to_slack(
                     ':announcement:',
                     f'{reqcount} open requests to {prj} / {", ".join(sorted(pkgs))} for review. '
@@ -319,143 +2225,547 @@ class Slacky:
                 )
 
         # Announce hanging repo publishes
-        for repo in self.repo_publishes.values():
-            if (
-                not repo.is_announced
-                and (repo.state_changed + HANGING_REPO_PUBLISH) < datetime.now()
-            ):
-                post_failure_notification_to_slack(
-                    ':published:',
-                    f'{repo.project} / {repo.repository} is not published after {HANGING_REPO_PUBLISH}',
-                    urllib.parse.urljoin(
-                        CONF['obs']['host'],
-                        f'/project/repository_state/{repo.project}/{repo.repository}',
-                    ),
-                )
-                repo.is_announced = True
+        for prjrepo in expired['repo_publish']:
+            repo = self.repo_publishes.get(prjrepo)
+            if not repo or repo.is_announced:
+                continue
+            if (due := repo.state_changed + HANGING_REPO_PUBLISH) >= now:
+                # the state changed after the entry got scheduled
+                self.deadlines.schedule_once(due, 'repo_publish', prjrepo)
+                continue
+            post_failure_notification_to_slack(
+                ':published:',
+                f'{repo.project} / {repo.repository} is not published after {HANGING_REPO_PUBLISH}',
+                urllib.parse.urljoin(
+                    CONF['obs']['host'],
+                    f'/project/repository_state/{repo.project}/{repo.repository}',
+                ),
+            )
+            self.mark_repo_announced(prjrepo)
 
         # Announce container tags that have not been published for a while
-        hanging_containers = sorted(
-            [
-                c
-                for c, publishdate in self.container_publishes.items()
-                if (
-                    (publishdate + HANGING_CONTAINER_TAG) < datetime.now()
-                    and (publishdate + HANGING_CONTAINER_TAG + timedelta(hours=2))
-                    > datetime.now()
-                )
-            ]
-        )
+        hanging_containers = []
+        for repo_tag in expired['container']:
+            if (published_at := self.container_publishes.get(repo_tag)) is None:
+                continue
+            if (due := published_at + HANGING_CONTAINER_TAG) >= now:
+                # published again after the entry got scheduled
+                self.deadlines.schedule_once(due, 'container', repo_tag)
+            elif due + timedelta(hours=2) > now:
+                hanging_containers.append(repo_tag)
+        hanging_containers.sort()
         if hanging_containers:
             post_failure_notification_to_slack(
                 ':question:',
                 f'These tags were not published after {HANGING_CONTAINER_TAG}: {",".join(hanging_containers)}',
                 'https://registry.suse.com/',
             )
-            for container in hanging_containers:
-                self.container_publishes.pop(container)
+            self.remove_container_publishes(hanging_containers)
 
         # Announce any openqa runs that have failures even after a while
-        builds_to_delete = []
-        for (group_id, build_id), build_results in self.openqa_jobs.items():
-            results = collections.Counter(j.result for j in build_results)
-            result_times = sorted(
-                [
-                    j.finished_at
-                    for j in filter(lambda x: x.finished_at is not None, build_results)
-                ],
-                reverse=True,
-            )
-            if (
-                len(result_times)
-                and result_times[0]
-                and (result_times[0] + OPENQA_FAIL_WAIT) < datetime.now()
-            ):
-                LOG.info(f'Job {build_id} ended - results: {results}')
-                if not results.get('pending') and results.get('failed'):
-                    body: str = (
-                        f"Build {build_id} has {results['failed']} failed tests."
-                    )
-                    post_failure_notification_to_slack(
-                        ':openqa:',
-                        body,
-                        urllib.parse.urljoin(
-                            CONF['openqa']['host'],
-                            f'/tests/overview?build={build_id}&groupid={group_id}',
-                        ),
-                    )
-                if not results.get('pending'):
-                    builds_to_delete.append((group_id, build_id))
-        for group_id, build_id in builds_to_delete:
-            del self.openqa_jobs[(group_id, build_id)]
+        for group_id, build_id in expired['openqa']:
+            build = self.openqa_jobs.get((group_id, build_id))
+            if not build or not build.last_finished:
+                continue
+            if (due := build.last_finished + OPENQA_FAIL_WAIT) >= now:
+                # jobs finished after the entry got scheduled
+                self.deadlines.schedule_once(due, 'openqa', (group_id, build_id))
+                continue
+            results = +build.results
+            LOG.info(
+                'Job %s ended - results: %s',
+                build_id,
+                results,
+                extra={'group_id': group_id, 'build': build_id},
+            )
+            if not results.get('pending') and results.get('failed'):
+                body: str = f"Build {build_id} has {results['failed']} failed tests."
+                post_failure_notification_to_slack(
+                    ':openqa:',
+                    body,
+                    urllib.parse.urljoin(
+                        CONF['openqa']['host'],
+                        f'/tests/overview?build={build_id}&groupid={group_id}',
+                    ),
+                )
+            if not results.get('pending'):
+                self.close_openqa_build(group_id, build_id)
+
+    def restore(
+        self,
+        openqa_jobs: dict[tuple[int, str], openQABuild],
+        bs_requests: dict[int, bs_Request],
+        repo_publishes: dict[str, repo_publish],
+        container_publishes: dict[str, datetime],
+        journal_seq: int = 0,
+        deadlines: DeadlineScheduler | None = None,
+    ) -> None:
+        """Replace the tracked state with the state loaded by a StateStore."""
+        self.state.openqa_jobs = openqa_jobs
+        self.state.bs_requests = bs_requests
+        self._index_requests()
+        self.state.repo_publishes = repo_publishes
+        self.state.container_publishes = container_publishes
+        self.state.journal_seq = journal_seq
+        self.state.deadlines = (
+            deadlines if deadlines is not None else DeadlineScheduler()
+        )
+        sizes = self.state_sizes()
+        LOG.info('Loaded state %s', sizes, extra=sizes)
+        LOG.debug(
+            'Loaded state(openqa_jobs = %s, bs_requests = %s, repo_publish = %s,'
+            ' container_publishes = %s)',
+            self.openqa_jobs,
+            self.bs_requests,
+            self.repo_publishes,
+            self.container_publishes,
+        )
 
     def load_state(self) -> None:
         """Restore persisted from a previously launched slacky"""
-        state_file = Path(__file__).resolve().parent / 'state.pickle'
-        if state_file.is_file():
-            with open(Path(__file__).resolve().parent / 'state.pickle', 'rb') as f:
-                data = pickle.load(f)
-                # copy over the state from a previous launched slacky
-                self.openqa_jobs = data.openqa_jobs
-                LOG.info(f'Loaded state(openqa_jobs = {self.openqa_jobs})')
-                self.bs_requests = data.bs_requests
-                LOG.info(f'Loaded state(bs_requests = {self.bs_requests})')
-                self.repo_publishes = data.repo_publishes
-                LOG.info(f'Loaded state(repo_publish = {self.repo_publishes})')
-                self.container_publishes = data.container_publishes
+        # the store already contains what it hands back, so don't journal it
+        store, self.store = self.store or SnapshotStateStore(STATE_DIR), None
+        try:
+            store.load(self)
+        finally:
+            self.store = store
+        self.schedule_deadlines()
+
+    def save_state(self) -> None:
+        """Persist the complete slacky state for future instance preservation"""
+        (self.store or SnapshotStateStore(STATE_DIR)).compact(self)
+
+    def bindings(self) -> list[str]:
+        """Routing keys to bind for the handlers enabled in the configuration."""
+        enabled = CONF['DEFAULT'].get('handlers', ','.join(EVENT_BINDINGS))
+        routing_keys = set()
+        for handler in filter(None, (h.strip() for h in enabled.split(','))):
+            if handler not in EVENT_BINDINGS:
+                raise ValueError(f'Unknown event handler {handler!r}')
+            routing_keys.update(EVENT_BINDINGS[handler])
+        if not routing_keys:
+            # nothing would ever be consumed
+            raise ValueError('No event handlers enabled in handlers')
+        return sorted(routing_keys)
+
+    @functools.cached_property
+    def dispatcher(self) -> Dispatcher:
+        dispatcher = Dispatcher()
+        for prefix, handler in EVENT_ROUTES.values():
+            dispatcher.register(prefix, getattr(self, handler), prefix=True)
+        return dispatcher
+
+    def register_handler(
+        self, routing_key: str, handler: Callable, prefix: bool = False
+    ) -> None:
+        """Call handler(routing_key, body) for events with the given routing key."""
+        self.dispatcher.register(routing_key, handler, prefix)
+
+    def dispatch(self, routing_key: str, body, timestamp: float | None = None) -> None:
+        """Hand an event posted on the AMPQ channel to the matching handler.
+
+        timestamp is the time the event was published as seconds since the
+        epoch, when known it is used to measure the lag of slacky.
+        """
+        handler = self.dispatcher.resolve(routing_key)
+        if timestamp is None:
+            self._handle(routing_key, body, handler)
+            return
+        self.consumer_lag.record(time.time() - timestamp)
+        token = EVENT_TIME.set(timestamp)
+        try:
+            self._handle(routing_key, body, handler)
+        finally:
+            EVENT_TIME.reset(token)
+
+    def _handle(self, routing_key: str, body, handler: Callable | None) -> None:
+        if METRICS is None:
+            if handler:
+                handler(routing_key, body)
+            return
+
+        family = routing_key_family(routing_key)
+        METRICS.inc('slacky_messages_received_total', family=family)
+        if not handler:
+            METRICS.inc('slacky_messages_filtered_total', family=family, reason='route')
+            return
+        start = time.perf_counter()
+        handled = handler(routing_key, body)
+        METRICS.observe(
+            'slacky_handler_duration_seconds',
+            time.perf_counter() - start,
+            handler=handler.__name__,
+        )
+        # the handlers return False for the events they drop
+        if handled is False:
+            METRICS.inc(
+                'slacky_messages_filtered_total', family=family, reason='handler'
+            )
+        else:
+            METRICS.inc('slacky_messages_handled_total', family=family)
+
+    def state_sizes(self) -> dict[str, int]:
+        """Number of entries in each of the tracked state maps."""
+        return {
+            name: len(getattr(self.state, name))
+            for name in (
+                'openqa_jobs',
+                'bs_requests',
+                'repo_publishes',
+                'container_publishes',
+                'build_failures',
+                'deadlines',
+            )
+        }
+
+    def interval_check(self) -> None:
+        """Run check_pending_requests() and record how long it took."""
+        start = time.perf_counter()
+        self.check_pending_requests()
+        self.last_check_duration = time.perf_counter() - start
+        if METRICS is not None:
+            METRICS.observe('slacky_check_duration_seconds', self.last_check_duration)
+        LOG.info(
+            'Checked pending requests in %.1f ms',
+            self.last_check_duration * 1000,
+            extra={'duration': self.last_check_duration},
+        )
+        if OUTBOX is not None:
+            stats = OUTBOX.stats()
+            LOG.info('Slack outbox: %s', stats, extra=stats)
+        for lag in (self.consumer_lag, NOTIFICATION_LAG):
+            if lag.samples:
+                percentiles = lag.percentiles()
                 LOG.info(
-                    f'Loaded state(container_publishes = {self.container_publishes})'
+                    '%s lag percentiles: %s',
+                    lag.name,
+                    percentiles,
+                    extra={'lag': percentiles},
                 )
+        if self.store and self.store.records >= self.journal_compact_records:
+            self.snapshot_state()
 
-    def save_state(self) -> None:
-        """pickle the slacky state for future instance preservation"""
-        with open(Path(__file__).resolve().parent / 'state.pickle', 'wb') as f:
-            pickle.dump(self, f)
-            LOG.info('Saved state to state.pickle')
+    def snapshot_state(self) -> None:
+        """Persist the complete slacky state in the background."""
+        if self.store is not None and not self.store.snapshot(self):
+            LOG.debug('Skipped state snapshot')
+
+    def toggle_profiling(self, *_signal) -> None:
+        """Profile the consumer for profile_seconds, or stop if already running."""
+        if self.profiler is not None:
+            self.stop_profiling()
+            return
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        self.profile_until = time.monotonic() + self.profile_seconds
+        LOG.warning('Profiling for %.0fs', self.profile_seconds)
+        self._schedule_profile_stop()
+
+    def _schedule_profile_stop(self) -> None:
+        """Stop the running profiler at profile_until on the current consumer."""
+        profiler = self.profiler
+        if profiler is None or self.call_later is None:
+            # while reconnecting, start_timers() schedules it once connected
+            return
+
+        def stop() -> None:
+            # unless stopped and maybe restarted by a signal in the meantime
+            if self.profiler is profiler:
+                self.stop_profiling()
+
+        self.call_later(max(0.0, self.profile_until - time.monotonic()), stop)
+
+    def stop_profiling(self) -> None:
+        """Stop the profiler and dump its stats to profile_dir."""
+        profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return
+        profiler.disable()
+        path = self.profile_dir / f'slacky-{datetime.now():%Y%m%d-%H%M%S-%f}.prof'
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+        LOG.warning('Saved profile to %s\n%s', path, summary.getvalue())
+
+    def report_state(self, *_signal) -> None:
+        """Log the size of the tracked state and the memory usage of slacky."""
+        rss = current_rss()
+        # in KiB on Linux
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        sizes = self.state_sizes()
+        LOG.warning(
+            'State sizes: %s, journal records: %d, outbox: %s, RSS: %s MiB,'
+            ' peak RSS: %d MiB',
+            sizes,
+            self.store.records if self.store else 0,
+            OUTBOX.stats() if OUTBOX is not None else None,
+            rss // 2**20 if rss is not None else 'unknown',
+            max_rss // 2**20,
+            extra={**sizes, 'rss': rss, 'max_rss': max_rss},
+        )
+
+    def start_timers(self, call_later: Callable[[float, Callable], object]) -> None:
+        """Schedule the periodic checks with the call_later() of the consumer."""
+        self.call_later = call_later
+        self._schedule_profile_stop()
+
+        def every(interval: timedelta, func: Callable) -> None:
+            def tick() -> None:
+                func()
+                call_later(interval.total_seconds(), tick)
+
+            call_later(interval.total_seconds(), tick)
+
+        every(self.check_interval, self.interval_check)
+        if self.build_fail_window:
+            every(self.build_fail_window, self.flush_build_failures)
+        if self.snapshot_interval:
+            every(self.snapshot_interval, self.snapshot_state)
+
+    def setup(self) -> None:
+        """Prepare the state shared by all consumer implementations.
+
+        Only the first call does anything, later connections of the same
+        instance carry on with the state in memory.
+        """
+        global SLACK_SESSION
+        if self.is_setup:
+            return
+        self.is_setup = True
+        self.store = open_state_store(CONF['DEFAULT'])
+        self.journal_compact_records = CONF['DEFAULT'].getint(
+            'journal_compact_records', 10000
+        )
+        self.load_state()
+        # start over with a journal that only holds changes made from now on
+        self.save_state()
+        self.project_re = re.compile(CONF['obs']['project_re'])
+        self.repo_re = re.compile(CONF['obs']['repo_re'])
+        select_json_decoder(CONF['DEFAULT'].get('json_decoder', 'auto'))
+        self.build_fail_window = timedelta(
+            seconds=CONF['obs'].getfloat('build_fail_window', 60)
+        )
+        self.check_interval = timedelta(
+            seconds=CONF['DEFAULT'].getfloat('check_interval', 120)
+        )
+        self.snapshot_interval = timedelta(
+            seconds=CONF['DEFAULT'].getfloat('snapshot_interval', 300)
+        )
+        self.profile_seconds = CONF['DEFAULT'].getfloat('profile_seconds', 30)
+        self.profile_dir = Path(CONF['DEFAULT'].get('profile_dir', str(STATE_DIR)))
+        lag_warning = CONF['DEFAULT'].getfloat('lag_warning', 60)
+        self.consumer_lag.threshold = NOTIFICATION_LAG.threshold = lag_warning
+        if METRICS is None and (port := CONF['DEFAULT'].getint('metrics_port', 0)):
+            start_metrics(port, CONF['DEFAULT'].get('metrics_address', 'localhost'))
+            METRICS.gauge('slacky_state_entries', 'map', self.state_sizes)
+            METRICS.gauge(
+                'slacky_consumer_lag_seconds', 'quantile', self.consumer_lag.percentiles
+            )
+            METRICS.gauge(
+                'slacky_notification_lag_seconds',
+                'quantile',
+                NOTIFICATION_LAG.percentiles,
+            )
+            METRICS.gauge(
+                'slacky_slack_outbox_depth',
+                'outbox',
+                lambda: {'slack': OUTBOX.depth} if OUTBOX is not None else {},
+            )
+        self.outbox_stop_timeout = CONF['DEFAULT'].getfloat('slack_stop_timeout', 30)
+        SLACK_SESSION = self.slack_session = SlackSession(
+            pool_size=CONF['DEFAULT'].getint('slack_pool_size', 4),
+            timeout=CONF['DEFAULT'].getfloat('slack_timeout', 10),
+        )
+        if OUTBOX is None and (
+            queue_size := CONF['DEFAULT'].getint('slack_queue_size', 1000)
+        ):
+            start_outbox(
+                queue_size,
+                CONF['DEFAULT'].get('slack_queue_overflow', 'drop_oldest'),
+                self.slack_session,
+                CONF['DEFAULT'].getint('slack_senders', 1),
+            )
 
     def run(self):
         """pubsub subscribe to events posted on the AMPQ channel."""
-        channel: BlockingChannel = pika.BlockingConnection(
+        connection = pika.BlockingConnection(
             pika.URLParameters(CONF['DEFAULT']['listen_url'])
-        ).channel()
+        )
+        channel: BlockingChannel = connection.channel()
         channel.exchange_declare(
             exchange='pubsub', exchange_type='topic', passive=True, durable=False
         )
         queue_name = channel.queue_declare('', exclusive=True).method.queue
-        channel.queue_bind(exchange='pubsub', queue=queue_name, routing_key='#')
+        for routing_key in self.bindings():
+            channel.queue_bind(
+                exchange='pubsub', queue=queue_name, routing_key=routing_key
+            )
 
-        self.load_state()
-        self.project_re = re.compile(CONF['obs']['project_re'])
-        self.repo_re = re.compile(CONF['obs']['repo_re'])
+        self.setup()
 
-        def callback(_, method, _unused, body) -> None:
+        def callback(_, method, properties, body) -> None:
             """Generic dispatcher for events posted on the AMPQ channel."""
-
-            if (datetime.now() - self.last_interval_check).total_seconds() > 120:
-                self.check_pending_requests()
-                self.last_interval_check = datetime.now()
-
-            routing_key = method.routing_key
-            if routing_key.startswith('suse.openqa'):
-                self.handle_openqa_event(routing_key, body)
-            elif routing_key.startswith('suse.obs.package'):
-                self.handle_obs_package_event(routing_key, body)
-            elif routing_key.startswith('suse.obs.request'):
-                self.handle_obs_request_event(routing_key, body)
-            elif routing_key.startswith('suse.obs.repo'):
-                self.handle_obs_repo_event(routing_key, body)
-            elif routing_key.startswith('suse.obs.container'):
-                self.handle_container_event(routing_key, body)
+            self.dispatch(method.routing_key, body, properties.timestamp)
 
         channel.basic_consume(queue_name, callback, auto_ack=True)
+        self.start_timers(connection.call_later)
         try:
             print(' [*] Waiting for events. To exit press CTRL+C')
             channel.start_consuming()
         except KeyboardInterrupt:
             channel.stop_consuming()
-            self.save_state()
-            LOG.info('State saved!')
-            sys.exit(0)
+            self.shutdown()
+        finally:
+            # the timers are gone with the connection
+            self.call_later = None
+
+    def run_async(self):
+        """pubsub subscribe to events using pika's asyncio adapter.
+
+        Events are dispatched on the event loop while slack posts are
+        scheduled as tasks, so message intake never waits for a webhook.
+        """
+        self.setup()
+        routing_keys = self.bindings()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        closed_reason: list[BaseException] = []
+
+        def on_message(_, method, properties, body) -> None:
+            self.dispatch(method.routing_key, body, properties.timestamp)
+
+        def on_channel_open(channel) -> None:
+            channel.add_on_close_callback(on_channel_closed)
+
+            def on_queue_declared(frame) -> None:
+                queue_name = frame.method.queue
+                unbound = set(routing_keys)
+
+                def on_bound(routing_key) -> None:
+                    unbound.discard(routing_key)
+                    if not unbound:
+                        channel.basic_consume(queue_name, on_message, auto_ack=True)
+
+                for routing_key in routing_keys:
+                    channel.queue_bind(
+                        queue_name,
+                        'pubsub',
+                        routing_key=routing_key,
+                        callback=lambda _, key=routing_key: on_bound(key),
+                    )
+
+            channel.exchange_declare(
+                exchange='pubsub',
+                exchange_type='topic',
+                passive=True,
+                durable=False,
+                callback=lambda _: channel.queue_declare(
+                    '', exclusive=True, callback=on_queue_declared
+                ),
+            )
+
+        def on_channel_closed(_, reason) -> None:
+            # e.g. the exchange or the queue is gone, reconnect to start over
+            closed_reason.append(reason)
+            if connection.is_open:
+                connection.close()
+
+        def on_closed(_, reason) -> None:
+            closed_reason.append(reason)
+            loop.stop()
+
+        connection = AsyncioConnection(
+            pika.URLParameters(CONF['DEFAULT']['listen_url']),
+            on_open_callback=lambda conn: conn.channel(
+                on_open_callback=on_channel_open
+            ),
+            on_open_error_callback=on_closed,
+            on_close_callback=on_closed,
+            custom_ioloop=loop,
+        )
+        self.start_timers(loop.call_later)
+        try:
+            print(' [*] Waiting for events. To exit press CTRL+C')
+            loop.run_forever()
+        except KeyboardInterrupt:
+            if not connection.is_closed:
+                connection.close()
+            self.shutdown()
+        finally:
+            # the posts would be lost with the loop, also when reconnecting
+            if PENDING_POSTS:
+                loop.run_until_complete(asyncio.gather(*PENDING_POSTS))
+            # the timers are gone with the loop
+            self.call_later = None
+            loop.close()
+
+        # supervise() reconnects on connection errors
+        reason = closed_reason[0] if closed_reason else None
+        if isinstance(reason, pika.exceptions.AMQPConnectionError):
+            raise reason
+        raise pika.exceptions.ConnectionClosed(0, str(reason))
+
+    def shutdown(self) -> None:
+        """Persist the state, announce what is pending and exit."""
+        # first, in case slack keeps us busy until we get killed
+        self.save_state()
+        LOG.info('State saved!')
+        self.flush_build_failures(force=True)
+        stop_outbox(self.outbox_stop_timeout)
+        sys.exit(0)
+
+    def supervise(self, run: Callable[[], None]) -> None:
+        """Call run() again whenever the connection to the broker is lost.
+
+        The tracked state stays in memory across reconnects. The delay
+        between attempts doubles up to reconnect_max_delay, with jitter so
+        that restarted consumers do not reconnect all at once, and starts
+        over once a connection lasted longer than that.
+        """
+        initial = CONF['DEFAULT'].getfloat('reconnect_delay', 10)
+        maximum = CONF['DEFAULT'].getfloat('reconnect_max_delay', 300)
+        attempt = 0
+        try:
+            while True:
+                connected_at = time.monotonic()
+                try:
+                    run()
+                except pika.exceptions.AMQPConnectionError as e:
+                    if time.monotonic() - connected_at > maximum:
+                        attempt = 0
+                    delay = min(maximum, initial * 2**attempt)
+                    delay = random.uniform(delay / 2, delay)
+                    attempt += 1
+                    LOG.warning(
+                        'Lost connection to the broker (%r), reconnecting in %.0fs',
+                        e,
+                        delay,
+                    )
+                    time.sleep(delay)
+        except KeyboardInterrupt:
+            # stopped while waiting to reconnect
+            self.shutdown()
+
+
+class JSONLogFormatter(LOG.Formatter):
+    """Format log records as JSON lines, including the fields passed as extra"""
+
+    # attributes of every log record, anything else was passed as extra
+    RECORD_FIELDS = frozenset(vars(LOG.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record: LOG.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
 
 
 def main():
@@ -463,6 +2773,18 @@ def main():
         description='Bot to forward BCI pipeline failures to Slack'
     )
     parse.add_argument('-d', '--debug', action='store_true')
+    parse.add_argument(
+        '--consumer',
+        choices=('blocking', 'asyncio'),
+        default='blocking',
+        help='AMQP consumer implementation to use',
+    )
+    parse.add_argument(
+        '--log-format',
+        choices=('text', 'json'),
+        default='text',
+        help='log plain text or JSON lines with structured fields',
+    )
 
     args = parse.parse_args()
     LOG.basicConfig(
@@ -470,6 +2792,9 @@ def main():
         datefmt='%y-%m-%d %H:%M:%S',
         format='%(asctime)s %(message)s',
     )
+    if args.log_format == 'json':
+        for handler in LOG.getLogger().handlers:
+            handler.setFormatter(JSONLogFormatter())
     LOG.getLogger('pika').setLevel(LOG.ERROR)
 
     with open(os.path.expanduser('~/.config/slacky'), encoding='utf8') as f:
@@ -479,12 +2804,10 @@ def main():
         raise KeyboardInterrupt
 
     signal.signal(signalnum=signal.SIGTERM, handler=handle_sigterm)
-    while True:
-        slacky = Slacky()
-        try:
-            slacky.run()
-        except (pika.exceptions.ConnectionClosed, pika.exceptions.AMQPHeartbeatTimeout):
-            time.sleep(random.randint(10, 100))
+    slacky = Slacky()
+    signal.signal(signalnum=signal.SIGUSR1, handler=slacky.toggle_profiling)
+    signal.signal(signalnum=signal.SIGUSR2, handler=slacky.report_state)
+    slacky.supervise(slacky.run_async if args.consumer == 'asyncio' else slacky.run)
 
 
 if __name__ == '__main__':
@@ -15,10 +15,25 @@ GNU General Public License for more details.
 SPDX-License-Identifier: GPL-2.0-or-later
 """
 
+import asyncio
 import collections
+import configparser
 import datetime
+import json
+import logging
+import pickle
+import pstats
 import re
-from unittest.mock import patch
+import signal
+import threading
+import time
+import types
+import urllib.request
+from unittest.mock import Mock, call, patch
+
+import pika
+import pytest
+import requests
 
 import slacky
 
@@ -33,22 +48,23 @@ def test_pending_bs_requests_grouping(mock_post_failure_notification):
     bot = slacky.Slacky()
     slacky.CONF = testing_CONF
 
-    bot.bs_requests = {
-        1: slacky.bs_Request(
+    bot.add_request(
+        slacky.bs_Request(
             id=1,
             targetproject='project1',
             targetpackage='package1',
             created_at=datetime.datetime(2023, 1, 2),
-        ),
-        2: slacky.bs_Request(
+        )
+    )
+    bot.add_request(
+        slacky.bs_Request(
             id=2,
             targetproject='project1',
             targetpackage='package2',
             created_at=datetime.datetime(2023, 1, 3),
-        ),
-    }
+        )
+    )
 
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
     bot.check_pending_requests()
     mock_post_failure_notification.assert_called_once_with(
         ':request-changes:',
@@ -64,15 +80,14 @@ def test_pending_bs_requests_single(mock_post_failure_notification):
     bot = slacky.Slacky()
     slacky.CONF = testing_CONF
 
-    bot.bs_requests = {
-        1: slacky.bs_Request(
+    bot.add_request(
+        slacky.bs_Request(
             id=1,
             targetproject='project1',
             targetpackage='package1',
             created_at=datetime.datetime(2023, 1, 2),
         )
-    }
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
+    )
     with patch('slacky.datetime') as mock_datetime:
         mock_datetime.now.return_value = datetime.datetime(
             2023, 1, 2
@@ -91,7 +106,6 @@ def test_pending_bs_requests_single(mock_post_failure_notification):
         bot.check_pending_requests()
         mock_post_failure_notification.assert_not_called()
 
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
     bot.check_pending_requests()
     mock_post_failure_notification.assert_called_once_with(
         ':request-changes:',
@@ -105,21 +119,22 @@ def test_pending_bs_requests_multiple(mock_post_failure_notification):
     bot = slacky.Slacky()
     slacky.CONF = testing_CONF
 
-    bot.bs_requests = {
-        1: slacky.bs_Request(
+    bot.add_request(
+        slacky.bs_Request(
             id=1,
             targetproject='project1',
             targetpackage='package1',
             created_at=datetime.datetime(2023, 1, 2),
-        ),
-        2: slacky.bs_Request(
+        )
+    )
+    bot.add_request(
+        slacky.bs_Request(
             id=2,
             targetproject='project1',
             targetpackage='package2',
             created_at=datetime.datetime(2023, 1, 2),
-        ),
-    }
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
+        )
+    )
     with patch('slacky.datetime') as mock_datetime:
         mock_datetime.now.return_value = datetime.datetime(
             2023, 1, 2
@@ -138,7 +153,6 @@ def test_pending_bs_requests_multiple(mock_post_failure_notification):
         bot.check_pending_requests()
         mock_post_failure_notification.assert_not_called()
 
-    bot.last_interval_check = datetime.datetime(2023, 1, 1)
     bot.check_pending_requests()
     mock_post_failure_notification.assert_called_once_with(
         ':request-changes:',
@@ -262,31 +276,27 @@ def test_openqa_failure(mock_post_failure_notification):
         bot.check_pending_requests()
         mock_post_failure_notification.assert_not_called()
 
-    assert bot.openqa_jobs == collections.defaultdict(
-        list,
-        {
-            (444, 'repo_23.2'): [
-                slacky.openQAJob(
-                    test_id='TEST1/x86_64',
-                    build='repo_23.2',
-                    result='failed',
-                    finished_at=datetime.datetime(2023, 1, 2, 0, 5),
-                ),
-                slacky.openQAJob(
-                    test_id='TEST1/aarch64',
-                    build='repo_23.2',
-                    result='passed',
-                    finished_at=datetime.datetime(2023, 1, 2, 0, 5),
-                ),
-                slacky.openQAJob(
-                    test_id='TEST1/ppc64le',
-                    build='repo_23.2',
-                    result='passed',
-                    finished_at=datetime.datetime(2023, 1, 2, 0, 5),
-                ),
-            ]
-        },
-    )
+    assert list(bot.openqa_jobs) == [(444, 'repo_23.2')]
+    assert list(bot.openqa_jobs[(444, 'repo_23.2')]) == [
+        slacky.openQAJob(
+            test_id='TEST1/x86_64',
+            build='repo_23.2',
+            result='failed',
+            finished_at=datetime.datetime(2023, 1, 2, 0, 5),
+        ),
+        slacky.openQAJob(
+            test_id='TEST1/aarch64',
+            build='repo_23.2',
+            result='passed',
+            finished_at=datetime.datetime(2023, 1, 2, 0, 5),
+        ),
+        slacky.openQAJob(
+            test_id='TEST1/ppc64le',
+            build='repo_23.2',
+            result='passed',
+            finished_at=datetime.datetime(2023, 1, 2, 0, 5),
+        ),
+    ]
     bot.check_pending_requests()
     mock_post_failure_notification.assert_called_with(
         ':openqa:',
@@ -294,3 +304,874 @@ def test_openqa_failure(mock_post_failure_notification):
         'https://localhost/tests/overview?build=repo_23.2&groupid=444',
     )
     assert len(bot.openqa_jobs) == 0
+
+
+def test_post_failure_notification_async():
+    slacky.CONF = {'DEFAULT': {'slack_trigger_url': 'https://localhost/hook'}}
+
+    async def notify():
+        slacky.post_failure_notification_to_slack(':obs:', 'body', 'link')
+        assert len(slacky.PENDING_POSTS) == 1
+        await asyncio.gather(*slacky.PENDING_POSTS)
+
+    with patch('slacky.requests.post') as mock_post:
+        asyncio.run(notify())
+        mock_post.assert_called_once_with(
+            url='https://localhost/hook',
+            headers={'Content-Type': 'application/json'},
+            json={'status': ':obs:', 'body': 'body', 'link_to_failure': 'link'},
+        )
+    assert not slacky.PENDING_POSTS
+
+    # with the session of Slacky, also without the outbox
+    with patch('slacky.SLACK_SESSION') as mock_session:
+        asyncio.run(notify())
+        slacky.post_failure_notification_to_slack(':obs:', 'inline', 'link')
+    assert [c.kwargs['json']['body'] for c in mock_session.post.call_args_list] == [
+        'body',
+        'inline',
+    ]
+
+
+def test_slack_outbox_overflow():
+    slacky.CONF = {'DEFAULT': {'slack_trigger_url': 'https://localhost/hook'}}
+    outbox = slacky.SlackOutbox(maxsize=2, overflow='drop_oldest')
+    for n in range(3):
+        outbox.put({'body': n})
+    assert outbox.stats() == {
+        'depth': 2,
+        'max_depth': 2,
+        'enqueued': 3,
+        'sent': 0,
+        'failed': 0,
+        'dropped': 1,
+    }
+
+    with patch('slacky._post_to_slack', return_value=True) as mock_post:
+        outbox.start()
+        outbox.stop()
+    assert [c.args[0] for c in mock_post.call_args_list] == [{'body': 1}, {'body': 2}]
+    assert outbox.sent == 2
+    assert outbox.depth == 0
+
+
+def test_slack_outbox_stop_timeout(caplog):
+    outbox = slacky.SlackOutbox(maxsize=2)
+    posting, slack_down = threading.Event(), threading.Event()
+
+    def post(payload, session=None):
+        posting.set()
+        slack_down.wait()
+        return False
+
+    with patch('slacky._post_to_slack', side_effect=post):
+        outbox.start()
+        outbox.put({'body': 0})
+        posting.wait()
+        outbox.put({'body': 1})
+        outbox.put({'body': 2})
+        start = time.monotonic()
+        outbox.stop(timeout=0.2)
+        assert time.monotonic() - start < 5
+        slack_down.set()
+    # the sender is stuck on the first one
+    assert outbox.dropped == 2
+    assert outbox.depth == 0
+    assert 'dropped 2 unsent notifications' in caplog.text
+
+
+def test_slack_session_pooling():
+    session = slacky.SlackSession(pool_size=8, timeout=3)
+    adapter = session.get_adapter('https://hooks.slack.com/')
+    assert adapter._pool_maxsize == 8
+
+    slacky.CONF = {'DEFAULT': {'slack_trigger_url': 'https://localhost/hook'}}
+    with patch('requests.Session.send') as mock_send:
+        mock_send.return_value.raise_for_status.return_value = None
+        assert slacky._post_to_slack({'body': 'x'}, session)
+        assert slacky._post_to_slack({'body': 'y'}, session)
+    assert mock_send.call_count == 2
+    assert mock_send.call_args.kwargs['timeout'] == 3
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_obs_build_fail_digest(mock_post_failure_notification):
+    bot = slacky.Slacky()
+    bot.project_re = re.compile(r'^SUSE:SLE-15-SP6:Update')
+    slacky.CONF = testing_CONF
+
+    with patch('slacky.datetime') as mock_datetime:
+        mock_datetime.now.return_value = datetime.datetime(2023, 1, 2)
+        for package, arch in (
+            ('pkg1', 'x86_64'),
+            ('pkg1', 'aarch64'),
+            ('pkg2', 'x86_64'),
+        ):
+            body = f'{{"project": "SUSE:SLE-15-SP6:Update", "package": "{package}", "repository": "standard", "arch": "{arch}"}}'
+            bot.handle_obs_package_event('suse.obs.package.build_fail', body)
+        body = '{"project": "SUSE:SLE-15-SP6:Update:BCI", "package": "pkg3", "repository": "images", "arch": "s390x"}'
+        bot.handle_obs_package_event('suse.obs.package.build_fail', body)
+        bot.flush_build_failures()
+        mock_post_failure_notification.assert_not_called()
+
+        mock_datetime.now.return_value += bot.build_fail_window
+        bot.flush_build_failures()
+
+    assert mock_post_failure_notification.call_args_list == [
+        call(
+            ':obs:',
+            '3 builds failed in SUSE:SLE-15-SP6:Update (aarch64: 1, x86_64: 2): pkg1, pkg2',
+            'https://localhost/project/monitor/SUSE:SLE-15-SP6:Update?failed=1',
+        ),
+        call(
+            ':obs:',
+            'SUSE:SLE-15-SP6:Update:BCI/pkg3/images/s390x failed to build.',
+            'https://localhost/package/live_build_log/SUSE:SLE-15-SP6:Update:BCI/pkg3/images/s390x',
+        ),
+    ]
+    assert not bot.build_failures
+
+
+def test_bindings():
+    bot = slacky.Slacky()
+    slacky.CONF = {'DEFAULT': {}}
+    assert bot.bindings() == [
+        'suse.obs.container.published',
+        'suse.obs.package.build_fail',
+        'suse.obs.repo.*',
+        'suse.obs.request.*',
+        'suse.openqa.job.*',
+    ]
+    slacky.CONF = {'DEFAULT': {'handlers': 'openqa, obs_request'}}
+    assert bot.bindings() == ['suse.obs.request.*', 'suse.openqa.job.*']
+
+
+def test_peek_json_field():
+    body = b'{"group_id": 444, "BUILD": "repo_23.2", "TEST": "TEST1", "reason": null}'
+    assert slacky.peek_json_field(body, 'group_id') == 444
+    assert slacky.peek_json_field(body.decode(), 'BUILD') == 'repo_23.2'
+    assert slacky.peek_json_field(body, 'reason') is None
+    assert slacky.peek_json_field(body, 'ARCH') is slacky.UNCERTAIN
+    # escaped, nested or repeated values need a full parse
+    assert slacky.peek_json_field(b'{"TEST": "a\\"b"}', 'TEST') is slacky.UNCERTAIN
+    assert slacky.peek_json_field(b'{"project": ["a"]}', 'project') is slacky.UNCERTAIN
+    body = b'{"project": "a", "x": {"project": "b"}}'
+    assert slacky.peek_json_field(body, 'project') is slacky.UNCERTAIN
+
+
+@patch('slacky.decode_event')
+def test_prefilter_skips_parsing(mock_loads):
+    bot = slacky.Slacky()
+    bot.project_re = re.compile(r'^SUSE:SLE-15-SP6:Update')
+    bot.handle_openqa_event('suse.openqa.job.create', b'{"group_id": 1, "BUILD": "1"}')
+    bot.handle_obs_package_event(
+        'suse.obs.package.build_fail', b'{"project": "openSUSE:Factory"}'
+    )
+    mock_loads.assert_not_called()
+
+
+def test_select_json_decoder():
+    try:
+        slacky.select_json_decoder('json')
+        assert slacky.decode_json is slacky.json.loads
+        with pytest.raises(ValueError):
+            slacky.select_json_decoder('yaml')
+    finally:
+        slacky.select_json_decoder()
+    assert slacky.decode_json is next(iter(slacky.JSON_DECODERS.values()))
+
+
+@pytest.mark.parametrize('decoder', slacky.JSON_DECODERS)
+def test_decode_event(decoder):
+    body = b'{"number": 1, "state": "new", "description": "x", "actions": [{"type": "submit", "targetproject": "SUSE:SLE-15-SP6:Update:BCI", "targetpackage": "test", "sourceproject": "home:x"}]}'
+    try:
+        slacky.select_json_decoder(decoder)
+        assert slacky.decode_event(slacky.obsRequestEvent, body) == (
+            slacky.obsRequestEvent(
+                number=1,
+                state='new',
+                actions=[
+                    slacky.obsRequestAction(
+                        type='submit',
+                        targetproject='SUSE:SLE-15-SP6:Update:BCI',
+                        targetpackage='test',
+                    )
+                ],
+            )
+        )
+        # wrongly typed values are decoded without validation
+        assert slacky.decode_event(
+            slacky.openQAJobEvent, b'{"group_id": 444, "BUILD": 23}'
+        ) == slacky.openQAJobEvent(group_id=444, BUILD=23)
+    finally:
+        slacky.select_json_decoder()
+
+
+def test_dispatcher():
+    dispatcher = slacky.Dispatcher()
+    dispatcher.register('suse.obs', 'obs', prefix=True)
+    dispatcher.register('suse.obs.package', 'package', prefix=True)
+    dispatcher.register('suse.obs.package.build_fail', 'build_fail')
+
+    assert dispatcher.resolve('suse.obs.package.build_fail') == 'build_fail'
+    assert dispatcher.resolve('suse.obs.package.build_success') == 'package'
+    assert dispatcher.resolve('suse.obs.repo.published') == 'obs'
+    assert dispatcher.resolve('suse.obsolete') is None
+    assert dispatcher.resolve('suse.openqa.job.done') is None
+
+    dispatcher.register('suse.openqa', 'openqa', prefix=True)
+    assert dispatcher.resolve('suse.openqa.job.done') == 'openqa'
+
+
+@patch('slacky.Slacky.handle_openqa_event')
+def test_dispatch(mock_handle_openqa_event):
+    bot = slacky.Slacky()
+    bot.dispatch('suse.openqa.job.done', b'{}')
+    mock_handle_openqa_event.assert_called_once_with('suse.openqa.job.done', b'{}')
+    bot.dispatch('suse.obs.metric', b'{}')
+
+
+def test_openqa_build_aggregates():
+    build = slacky.openQABuild()
+    job1 = slacky.openQAJob(test_id='TEST1/x86_64', build='1', result='pending')
+    job2 = slacky.openQAJob(test_id='TEST2/x86_64', build='1', result='pending')
+    build.add(job1)
+    build.add(job2)
+    assert build.pending == 2
+
+    build.finish(job1, 'failed', datetime.datetime(2023, 1, 2, 1))
+    build.finish(job2, 'passed', datetime.datetime(2023, 1, 2, 2))
+    assert +build.results == {'failed': 1, 'passed': 1}
+    assert build.last_finished == datetime.datetime(2023, 1, 2, 2)
+
+    build.restart(job2)
+    assert +build.results == {'failed': 1, 'pending': 1}
+    assert job2.finished_at is None
+    assert build.find('TEST2/x86_64') == [job2]
+
+
+def test_deadline_scheduler():
+    deadlines = slacky.DeadlineScheduler()
+    deadlines.schedule(datetime.datetime(2023, 1, 3), 'repo_publish', 'a')
+    deadlines.schedule(datetime.datetime(2023, 1, 1), 'container', 'b')
+    deadlines.schedule(datetime.datetime(2023, 1, 2), 'container', 'c')
+
+    assert deadlines.pop_expired(datetime.datetime(2023, 1, 1)) == {}
+    assert deadlines.pop_expired(datetime.datetime(2023, 1, 2, 1)) == {
+        'container': {
+            'b': datetime.datetime(2023, 1, 1),
+            'c': datetime.datetime(2023, 1, 2),
+        }
+    }
+    assert len(deadlines) == 1
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_obs_repo_published_in_time(mock_post_failure_notification):
+    bot = slacky.Slacky()
+    bot.repo_re = re.compile(r'^SUSE:Containers:SLE-SERVER:')
+    slacky.CONF = testing_CONF
+
+    with patch('slacky.datetime') as mock_datetime:
+        mock_datetime.now.return_value = datetime.datetime(2023, 1, 2)
+        body = '{"state": "publishing", "project": "SUSE:Containers:SLE-SERVER:15", "repo": "images"}'
+        bot.handle_obs_repo_event('suse.obs.repo.publish_state', body)
+        mock_datetime.now.return_value += datetime.timedelta(minutes=10)
+        body = '{"state": "published", "project": "SUSE:Containers:SLE-SERVER:15", "repo": "images"}'
+        bot.handle_obs_repo_event('suse.obs.repo.published', body)
+    assert len(bot.deadlines) == 1
+    bot.check_pending_requests()
+    mock_post_failure_notification.assert_not_called()
+    assert len(bot.deadlines) == 0
+
+
+def test_start_timers():
+    bot = slacky.Slacky()
+    timers = []
+    with (
+        patch.object(bot, 'check_pending_requests') as mock_check,
+        patch.object(bot, 'flush_build_failures') as mock_flush,
+    ):
+        bot.start_timers(lambda delay, callback: timers.append((delay, callback)))
+        assert [delay for delay, _ in timers] == [120, 60, 300]
+
+        timers.pop(0)[1]()
+        mock_check.assert_called_once_with()
+        mock_flush.assert_not_called()
+        assert timers[-1][0] == 120
+    assert bot.last_check_duration > 0
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_bs_requests_by_project(mock_post_failure_notification):
+    bot = slacky.Slacky()
+    slacky.CONF = testing_CONF
+
+    for number, project in ((1, 'BCI:A'), (2, 'BCI:B'), (3, 'BCI:A')):
+        body = f'{{"number": {number}, "actions": [{{"type": "submit", "targetproject": "{project}", "targetpackage": "pkg{number}"}}]}}'
+        bot.handle_obs_request_event('suse.obs.request.create', body)
+    assert bot.requests_by_project == {'BCI:A': {1, 3}, 'BCI:B': {2}}
+
+    body = '{"number": 2, "state": "accepted"}'
+    bot.handle_obs_request_event('suse.obs.request.state_change', body)
+    assert bot.requests_by_project == {'BCI:A': {1, 3}}
+    assert [req.id for req in bot.project_requests('BCI:A')] == [1, 3]
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_state_journal_replay(mock_post_failure_notification, tmp_path):
+    bot = slacky.Slacky()
+    bot.store = slacky.JournalStateStore(tmp_path)
+    bot.repo_re = re.compile(r'^SUSE:Containers:SLE-SERVER:')
+    slacky.CONF = testing_CONF
+
+    body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1"}'
+    bot.handle_openqa_event('suse.openqa.job.create', body)
+    body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1", "result": "failed"}'
+    bot.handle_openqa_event('suse.openqa.job.done', body)
+    body = '{"number": 1, "actions": [{"type": "submit", "targetproject": "SUSE:SLE-15-SP6:Update:BCI", "targetpackage": "test"}]}'
+    bot.handle_obs_request_event('suse.obs.request.create', body)
+    body = '{"number": 1, "state": "declined"}'
+    bot.handle_obs_request_event('suse.obs.request.state_change', body)
+    body = '{"state": "publishing", "project": "SUSE:Containers:SLE-SERVER:15", "repo": "images"}'
+    bot.handle_obs_repo_event('suse.obs.repo.publish_state', body)
+    body = '{"project": "SUSE:Containers:SLE-SERVER:15", "container": "registry.suse.com/suse/sle15:15.5"}'
+    bot.handle_container_event('suse.obs.container.published', body)
+
+    records = slacky.StateJournal.read(tmp_path / 'state.journal')
+    assert [r['op'] for r in records] == [
+        'job_created',
+        'job_finished',
+        'request_created',
+        'request_announced',
+        'repo_state',
+        'container_published',
+    ]
+
+    restored = slacky.Slacky()
+    for record in records + records[:2]:
+        restored.replay(record)
+    assert restored.journal_seq == bot.journal_seq == 6
+    assert restored.openqa_jobs == bot.openqa_jobs
+    assert restored.bs_requests == bot.bs_requests
+    assert restored.repo_publishes == bot.repo_publishes
+    assert restored.container_publishes == bot.container_publishes
+
+    bot.save_state()
+    assert slacky.StateJournal.read(tmp_path / 'state.journal') == []
+    restored = slacky.Slacky()
+    restored.store = slacky.JournalStateStore(tmp_path)
+    restored.load_state()
+    assert restored.journal_seq == 6
+    assert restored.openqa_jobs == bot.openqa_jobs
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_sqlite_state_store(mock_post_failure_notification, tmp_path):
+    bot = slacky.Slacky()
+    bot.store = slacky.SQLiteStateStore(tmp_path / 'state.sqlite')
+    bot.repo_re = re.compile(r'^SUSE:Containers:SLE-SERVER:')
+    slacky.CONF = testing_CONF
+
+    body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1"}'
+    bot.handle_openqa_event('suse.openqa.job.create', body)
+    bot.handle_openqa_event('suse.openqa.job.create', body.replace('TEST1', 'TEST2'))
+    body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1", "result": "failed"}'
+    bot.handle_openqa_event('suse.openqa.job.done', body)
+    for number in (1, 2):
+        body = f'{{"number": {number}, "actions": [{{"type": "submit", "targetproject": "SUSE:SLE-15-SP6:Update:BCI", "targetpackage": "test"}}]}}'
+        bot.handle_obs_request_event('suse.obs.request.create', body)
+    body = '{"number": 1, "state": "declined"}'
+    bot.handle_obs_request_event('suse.obs.request.state_change', body)
+    bot.mark_requests_announced([2], create_only=True)
+    body = '{"state": "publishing", "project": "SUSE:Containers:SLE-SERVER:15", "repo": "images"}'
+    bot.handle_obs_repo_event('suse.obs.repo.publish_state', body)
+    body = '{"project": "SUSE:Containers:SLE-SERVER:15", "container": "registry.suse.com/suse/sle15:15.5"}'
+    bot.handle_container_event('suse.obs.container.published', body)
+    bot.save_state()
+    bot.store.close()
+
+    restored = slacky.Slacky()
+    restored.store = slacky.SQLiteStateStore(tmp_path / 'state.sqlite')
+    restored.load_state()
+    assert restored.openqa_jobs == bot.openqa_jobs
+    assert restored.openqa_jobs[(444, 'repo_23.2')].results == {
+        'pending': 1,
+        'failed': 1,
+    }
+    assert restored.bs_requests == bot.bs_requests
+    assert restored.bs_requests[2].is_create_announced
+    assert restored.requests_by_project == {'SUSE:SLE-15-SP6:Update:BCI': {1, 2}}
+    assert restored.repo_publishes == bot.repo_publishes
+    assert restored.container_publishes == bot.container_publishes
+    # replayed state is not written back to the store
+    assert restored.store.records == 0
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_sqlite_state_store_queries(mock_post_failure_notification, tmp_path):
+    slacky.CONF = testing_CONF
+    bot = slacky.Slacky()
+    bot.store = slacky.SQLiteStateStore(tmp_path / 'state.sqlite')
+    bot.load_state()
+    now = datetime.datetime.now()
+    bot.create_openqa_job(444, 'repo_23.2', 'TEST1')
+    bot.finish_openqa_job(
+        444, 'repo_23.2', 'TEST1', 'failed', now - datetime.timedelta(hours=1)
+    )
+    bot.create_openqa_job(444, 'repo_23.3', 'TEST1')
+    bot.add_request(
+        slacky.bs_Request(
+            1, 'SUSE:SLE-15-SP6:Update:BCI', 'test', now - datetime.timedelta(hours=13)
+        )
+    )
+    bot.add_container_publish(
+        'suse/sle15:15.5',
+        now - slacky.HANGING_CONTAINER_TAG - datetime.timedelta(hours=1),
+    )
+    assert len(bot.deadlines) == 0
+    bot.store.close()
+
+    restored = slacky.Slacky()
+    restored.store = slacky.SQLiteStateStore(tmp_path / 'state.sqlite', cached_builds=1)
+    restored.load_state()
+    # the builds are read when they are looked up
+    assert restored.openqa_jobs._cache == {}
+    assert len(restored.openqa_jobs) == 2
+    expired = restored.store.expired(now)
+    assert list(expired['openqa']) == [(444, 'repo_23.2')]
+    assert list(expired['request_hanging']) == [1]
+    assert list(expired['container']) == ['suse/sle15:15.5']
+    assert 'request_created' not in expired
+
+    restored.check_pending_requests()
+    assert mock_post_failure_notification.call_count == 3
+    assert 'Build repo_23.2 has 1 failed tests.' in str(
+        mock_post_failure_notification.call_args_list
+    )
+    assert restored.store.expired(now) == {}
+    assert list(restored.openqa_jobs) == [(444, 'repo_23.3')]
+
+    # checkpointed once enough operations were written
+    restored.journal_compact_records = 3
+    for n in range(2, 5):
+        restored.create_openqa_job(444, 'repo_23.3', f'TEST{n}')
+    assert restored.store.records == 6
+    restored.interval_check()
+    assert restored.store.records == 0
+    assert restored.openqa_jobs[(444, 'repo_23.3')].results == {'pending': 4}
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_state_snapshot(mock_post_failure_notification, tmp_path):
+    bot = slacky.Slacky()
+    bot.store = slacky.JournalStateStore(tmp_path)
+    slacky.CONF = testing_CONF
+
+    body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1"}'
+    bot.handle_openqa_event('suse.openqa.job.create', body)
+    with patch('slacky.write_atomic', side_effect=OSError('disk full')):
+        with pytest.raises(OSError):
+            bot.store.compact(bot)
+    # the records stay around until a snapshot containing them got written
+    assert not (tmp_path / 'state.snapshot').exists()
+    assert len(slacky.StateJournal.read(tmp_path / 'state.journal.old')) == 1
+
+    bot.handle_openqa_event('suse.openqa.job.create', body.replace('TEST1', 'TEST2'))
+    assert bot.store.snapshot(bot)
+    bot.store.compact(bot)  # waits for the background snapshot
+    assert not (tmp_path / 'state.journal.old').exists()
+    assert bot.store.snapshot_size == (tmp_path / 'state.snapshot').stat().st_size
+    assert not list(tmp_path.glob('.*.tmp'))
+
+    restored = slacky.Slacky()
+    restored.store = slacky.JournalStateStore(tmp_path)
+    restored.load_state()
+    assert restored.openqa_jobs == bot.openqa_jobs
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_state_format(mock_post_failure_notification, tmp_path):
+    bot = slacky.Slacky()
+    bot.repo_re = re.compile(r'^SUSE:Containers:SLE-SERVER:')
+    slacky.CONF = testing_CONF
+
+    body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1", "result": "failed"}'
+    bot.handle_openqa_event('suse.openqa.job.create', body)
+    bot.handle_openqa_event('suse.openqa.job.done', body)
+    body = '{"number": 1, "actions": [{"type": "submit", "targetproject": "SUSE:SLE-15-SP6:Update:BCI", "targetpackage": "test"}]}'
+    bot.handle_obs_request_event('suse.obs.request.create', body)
+    body = '{"state": "publishing", "project": "SUSE:Containers:SLE-SERVER:15", "repo": "images"}'
+    bot.handle_obs_repo_event('suse.obs.repo.publish_state', body)
+
+    # state of older releases is migrated from the pickled instance, with the
+    # attributes of the baseline Slacky class
+    legacy = types.SimpleNamespace(
+        openqa_jobs=collections.defaultdict(
+            list, {qajob: list(build) for qajob, build in bot.openqa_jobs.items()}
+        ),
+        bs_requests=collections.defaultdict(None, bot.bs_requests),
+        repo_publishes=dict(bot.repo_publishes),
+        container_publishes={},
+    )
+    (tmp_path / 'state.pickle').write_bytes(pickle.dumps(legacy))
+    restored = slacky.Slacky()
+    restored.store = slacky.SnapshotStateStore(tmp_path)
+    restored.load_state()
+    assert restored.openqa_jobs == bot.openqa_jobs
+    assert restored.bs_requests == bot.bs_requests
+    assert type(restored.bs_requests) is dict
+    assert restored.repo_publishes == bot.repo_publishes
+    assert restored.requests_by_project == {'SUSE:SLE-15-SP6:Update:BCI': {1}}
+    restored.save_state()
+    assert not (tmp_path / 'state.pickle').exists()
+
+    data = (tmp_path / 'state.snapshot').read_bytes()
+    assert data.startswith(b'SLKY\x00\x01')
+    state = slacky.decode_state(data)
+    assert state['openqa_jobs'] == bot.openqa_jobs
+    assert state['bs_requests'] == bot.bs_requests
+    assert state['repo_publishes'] == bot.repo_publishes
+
+    header = slacky.STATE_HEADER.pack(slacky.STATE_MAGIC, 0)
+    with patch.dict(
+        slacky.STATE_MIGRATIONS, {0: lambda doc: {**doc, 'journal_seq': 42}}
+    ):
+        old = slacky.decode_state(header + data[slacky.STATE_HEADER.size :])
+    assert old['journal_seq'] == 42
+    header = slacky.STATE_HEADER.pack(slacky.STATE_MAGIC, slacky.STATE_VERSION + 1)
+    with pytest.raises(ValueError):
+        slacky.decode_state(header + data[slacky.STATE_HEADER.size :])
+
+
+def test_supervise_reconnects():
+    bot = slacky.Slacky()
+    slacky.CONF = configparser.ConfigParser()
+    slacky.CONF.read_dict({'DEFAULT': {'reconnect_max_delay': '30'}})
+    run = [
+        pika.exceptions.ConnectionClosed(320, 'CONNECTION_FORCED'),
+        pika.exceptions.AMQPHeartbeatTimeout(),
+        pika.exceptions.StreamLostError(),
+        SystemExit(0),
+    ]
+    with (
+        patch.object(bot, 'run', side_effect=run) as mock_run,
+        patch('slacky.time.sleep') as mock_sleep,
+        patch('slacky.random.uniform', side_effect=lambda low, high: high),
+    ):
+        with pytest.raises(SystemExit):
+            bot.supervise(bot.run)
+    assert mock_run.call_count == 4
+    assert mock_sleep.call_args_list == [call(10), call(20), call(30)]
+
+
+def test_supervise_interrupted_while_waiting():
+    bot = slacky.Slacky()
+    slacky.CONF = configparser.ConfigParser()
+    with (
+        patch.object(bot, 'run', side_effect=pika.exceptions.StreamLostError()),
+        patch('slacky.time.sleep', side_effect=KeyboardInterrupt),
+        patch.object(bot, 'flush_build_failures') as mock_flush,
+        patch.object(bot, 'save_state') as mock_save,
+        patch('slacky.stop_outbox') as mock_stop,
+    ):
+        with pytest.raises(SystemExit) as exc:
+            bot.supervise(bot.run)
+    assert exc.value.code == 0
+    mock_flush.assert_called_once_with(force=True)
+    mock_stop.assert_called_once_with(30)
+    mock_save.assert_called_once_with()
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_state_per_instance(mock_post_failure_notification):
+    slacky.CONF = testing_CONF
+    first, second = slacky.Slacky(), slacky.Slacky()
+    first.project_re = re.compile(r'^SUSE:SLE-15-SP6:')
+    body = '{"project": "SUSE:SLE-15-SP6:Update:BCI", "package": "pkg", "repository": "images", "arch": "x86_64"}'
+    first.handle_obs_package_event('suse.obs.package.build_fail', body)
+    assert list(first.build_failures) == ['SUSE:SLE-15-SP6:Update:BCI']
+    assert second.build_failures == {}
+
+    shared = slacky.SlackyState()
+    assert slacky.Slacky(shared).openqa_jobs is shared.openqa_jobs
+    # replaced through restore(), which keeps the indexes and deadlines in sync
+    with pytest.raises(AttributeError):
+        first.repo_publishes = {}
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_metrics_endpoint(mock_post_failure_notification):
+    bot = slacky.Slacky()
+    bot.repo_re = re.compile(r'^SUSE:Containers:SLE-SERVER:')
+    slacky.CONF = testing_CONF
+    metrics = slacky.start_metrics(0)
+    try:
+        metrics.gauge('slacky_state_entries', 'map', bot.state_sizes)
+        body = (
+            '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1"}'
+        )
+        bot.dispatch('suse.openqa.job.create', body)
+        bot.dispatch('suse.openqa.job.create', body.replace('TEST1', 'TEST2'))
+        bot.dispatch('suse.openqa.job.create', body.replace('444', '999'))
+        body = '{"state": "publishing", "project": "SUSE:SLE-15", "repo": "images"}'
+        bot.dispatch('suse.obs.repo.publish_state', body)
+        bot.dispatch('suse.obs.metric.unknown', '{}')
+
+        url = f'http://localhost:{slacky.METRICS_SERVER.server_port}/metrics'
+        with urllib.request.urlopen(url) as resp:
+            text = resp.read().decode()
+    finally:
+        slacky.stop_metrics()
+
+    assert 'slacky_messages_received_total{family="suse.openqa.job"} 3' in text
+    assert 'slacky_messages_handled_total{family="suse.openqa.job"} 2' in text
+    assert (
+        'slacky_messages_filtered_total{family="suse.openqa.job",reason="handler"} 1'
+        in text
+    )
+    assert (
+        'slacky_messages_filtered_total{family="suse.obs.repo",reason="handler"} 1'
+        in text
+    )
+    assert 'slacky_messages_handled_total{family="suse.obs.repo"}' not in text
+    assert (
+        'slacky_messages_filtered_total{family="suse.obs.metric",reason="route"} 1'
+        in text
+    )
+    assert (
+        'slacky_handler_duration_seconds_count{handler="handle_openqa_event"} 3' in text
+    )
+    assert 'slacky_state_entries{map="openqa_jobs"} 1' in text
+    assert slacky.METRICS is None
+
+
+def test_event_lag(caplog):
+    bot = slacky.Slacky()
+    slacky.CONF = {
+        **testing_CONF,
+        'DEFAULT': {'slack_trigger_url': 'https://localhost/hook'},
+    }
+    slacky.NOTIFICATION_LAG.samples.clear()
+    now = time.time()
+    with patch('slacky.requests.post') as mock_post:
+        body = '{"number": 1, "actions": [{"type": "submit", "targetproject": "SUSE:SLE-15-SP6:Update:BCI", "targetpackage": "test"}]}'
+        bot.dispatch('suse.obs.request.create', body, now - 5)
+        body = '{"number": 1, "state": "declined"}'
+        bot.dispatch('suse.obs.request.state_change', body, now - 90)
+        slacky.post_failure_notification_to_slack(':x:', 'not an event', '')
+        # nothing is recorded for a notification that did not get posted
+        mock_post.return_value.raise_for_status.side_effect = requests.HTTPError()
+        bot.dispatch('suse.obs.request.state_change', body, now - 30)
+    assert mock_post.call_count == 3
+    assert 'event_time' not in mock_post.call_args_list[0].kwargs['json']
+    assert len(bot.consumer_lag.samples) == 3
+    assert bot.consumer_lag.percentiles()['1'] >= 90
+    # the notification outside of an event handler has no lag to measure
+    assert len(slacky.NOTIFICATION_LAG.samples) == 1
+    assert slacky.NOTIFICATION_LAG.samples[0] >= 90
+    assert 'Consumer lag of 90s exceeds 60s' in caplog.text
+    assert slacky.EVENT_TIME.get() is None
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_profiling_toggle(mock_post_failure_notification, tmp_path, caplog):
+    bot = slacky.Slacky()
+    bot.profile_dir = tmp_path
+    slacky.CONF = testing_CONF
+    timers = []
+    bot.call_later = lambda delay, callback: timers.append((delay, callback))
+
+    bot.toggle_profiling(signal.SIGUSR1, None)
+    body = '{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST1"}'
+    bot.dispatch('suse.openqa.job.create', body)
+    # a second signal stops early, the timer of the first run does nothing
+    bot.toggle_profiling(signal.SIGUSR1, None)
+    bot.toggle_profiling(signal.SIGUSR1, None)
+    assert [delay for delay, _ in timers] == pytest.approx([30, 30], abs=1)
+    timers[0][1]()
+    assert bot.profiler is not None
+    timers[1][1]()
+    assert bot.profiler is None
+
+    profiles = sorted(tmp_path.glob('slacky-*.prof'))
+    assert len(profiles) == 2
+    functions = pstats.Stats(str(profiles[0])).stats
+    assert any(name == 'handle_openqa_event' for _, _, name in functions)
+
+    # started while reconnecting, stopped by the timers of the next consumer
+    bot.call_later = None
+    bot.toggle_profiling(signal.SIGUSR1, None)
+    timers.clear()
+    bot.start_timers(lambda delay, callback: timers.append((delay, callback)))
+    delay, stop = timers[0]
+    assert 0 < delay <= 30
+    stop()
+    assert bot.profiler is None
+
+    bot.report_state(signal.SIGUSR2, None)
+    assert "State sizes: {'openqa_jobs': 1" in caplog.text
+    assert caplog.records[-1].rss > 0
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_json_log_format(mock_post_failure_notification, caplog):
+    bot = slacky.Slacky()
+    slacky.CONF = testing_CONF
+    body = '{"number": 1, "actions": [{"type": "submit", "targetproject": "SUSE:SLE-15-SP6:Update:BCI", "targetpackage": "test"}]}'
+    with caplog.at_level(logging.INFO):
+        bot.handle_obs_request_event('suse.obs.request.create', body)
+
+    entry = json.loads(slacky.JSONLogFormatter().format(caplog.records[-1]))
+    assert entry['level'] == 'INFO'
+    assert entry['message'] == (
+        'found new submitrequest against SUSE:SLE-15-SP6:Update:BCI: id 1'
+    )
+    assert entry['routing_key'] == 'suse.obs.request.create'
+    assert entry['project'] == 'SUSE:SLE-15-SP6:Update:BCI'
+    assert entry['request_id'] == 1
+    assert 'args' not in entry
+
+
+def test_run_async_binds_before_consuming():
+    bot = slacky.Slacky()
+    bot.is_setup = True
+    slacky.CONF = {
+        'DEFAULT': {'listen_url': 'amqp://localhost', 'handlers': 'openqa, obs_request'}
+    }
+    channel = Mock()
+    channel.exchange_declare.side_effect = lambda **kwargs: kwargs['callback'](None)
+    channel.queue_declare.side_effect = lambda name, exclusive, callback: callback(
+        types.SimpleNamespace(method=types.SimpleNamespace(queue='q1'))
+    )
+    bound = []
+    channel.queue_bind.side_effect = lambda queue, exchange, routing_key, callback: (
+        bound.append(callback)
+    )
+
+    def connect(parameters, on_open_callback, on_close_callback, custom_ioloop, **_):
+        connection = Mock()
+        connection.channel.side_effect = lambda on_open_callback: on_open_callback(
+            channel
+        )
+        on_open_callback(connection)
+        assert [c.kwargs['routing_key'] for c in channel.queue_bind.call_args_list] == [
+            'suse.obs.request.*',
+            'suse.openqa.job.*',
+        ]
+        bound[0](None)
+        channel.basic_consume.assert_not_called()
+        bound[1](None)
+        channel.basic_consume.assert_called_once()
+        # the broker closing the channel closes the connection
+        (on_channel_closed,) = channel.add_on_close_callback.call_args.args
+        connection.is_open = True
+        connection.close.side_effect = lambda: custom_ioloop.call_soon(
+            on_close_callback,
+            connection,
+            pika.exceptions.ConnectionClosedByClient(200, 'Normal shutdown'),
+        )
+        custom_ioloop.call_soon(
+            on_channel_closed,
+            channel,
+            pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND'),
+        )
+        return connection
+
+    with (
+        patch('slacky.AsyncioConnection', side_effect=connect),
+        patch.object(bot, 'dispatch') as mock_dispatch,
+    ):
+        with pytest.raises(pika.exceptions.ConnectionClosed, match='NOT_FOUND'):
+            bot.run_async()
+        # the timers of the closed loop are not used any more
+        assert bot.call_later is None
+        queue_name, on_message = channel.basic_consume.call_args.args
+        assert queue_name == 'q1'
+        on_message(
+            channel,
+            types.SimpleNamespace(routing_key='suse.openqa.job.done'),
+            types.SimpleNamespace(timestamp=1700000000),
+            b'{}',
+        )
+    mock_dispatch.assert_called_once_with('suse.openqa.job.done', b'{}', 1700000000)
+
+    slacky.CONF['DEFAULT']['handlers'] = ''
+    with pytest.raises(ValueError, match='No event handlers'):
+        bot.run_async()
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_openqa_build_single_deadline(mock_post_failure_notification):
+    bot = slacky.Slacky()
+    slacky.CONF = testing_CONF
+    start = datetime.datetime(2023, 1, 2)
+
+    with patch('slacky.datetime') as mock_datetime:
+        mock_datetime.now.return_value = start
+        for n in range(100):
+            body = f'{{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST{n}"}}'
+            bot.handle_openqa_event('suse.openqa.job.create', body)
+        for n in range(100):
+            mock_datetime.now.return_value = start + datetime.timedelta(minutes=n)
+            body = f'{{"group_id": 444, "BUILD": "repo_23.2", "ARCH": "x86_64", "TEST": "TEST{n}", "result": "failed"}}'
+            bot.handle_openqa_event('suse.openqa.job.done', body)
+        assert len(bot.deadlines) == 1
+
+        # the first deadline passed, but jobs kept finishing until minute 99
+        mock_datetime.now.return_value = (
+            start + slacky.OPENQA_FAIL_WAIT + datetime.timedelta(minutes=1)
+        )
+        bot.check_pending_requests()
+        mock_post_failure_notification.assert_not_called()
+        assert len(bot.deadlines) == 1
+
+        mock_datetime.now.return_value = (
+            start + slacky.OPENQA_FAIL_WAIT + datetime.timedelta(minutes=100)
+        )
+        bot.check_pending_requests()
+    mock_post_failure_notification.assert_called_once()
+    assert 'Build repo_23.2 has 100 failed tests.' in str(
+        mock_post_failure_notification.call_args
+    )
+    assert bot.openqa_jobs == {}
+    assert len(bot.deadlines) == 0
+
+
+@patch('slacky.post_failure_notification_to_slack', return_value=None)
+def test_container_and_repo_single_deadline(mock_post_failure_notification):
+    bot = slacky.Slacky()
+    slacky.CONF = testing_CONF
+    start = datetime.datetime(2023, 1, 2)
+    for n in range(100):
+        published_at = start + datetime.timedelta(hours=n)
+        bot.add_container_publish('suse/sle15:15.5', published_at)
+        bot.set_repo_state(
+            'SUSE:Containers:SLE-SERVER:15', 'images', 'publishing', published_at
+        )
+    assert len(bot.deadlines) == 2
+
+    with patch('slacky.datetime') as mock_datetime:
+        # the first deadlines passed, but both changed until hour 99
+        mock_datetime.now.return_value = (
+            start + slacky.HANGING_REPO_PUBLISH + datetime.timedelta(minutes=1)
+        )
+        bot.check_pending_requests()
+        mock_post_failure_notification.assert_not_called()
+        assert len(bot.deadlines) == 2
+
+        mock_datetime.now.return_value = (
+            start + slacky.HANGING_CONTAINER_TAG + datetime.timedelta(minutes=1)
+        )
+        bot.check_pending_requests()
+        assert mock_post_failure_notification.call_count == 1
+        assert bot.repo_publishes['SUSE:Containers:SLE-SERVER:15/images'].is_announced
+        assert len(bot.deadlines) == 1
+
+        mock_datetime.now.return_value = (
+            published_at + slacky.HANGING_CONTAINER_TAG + datetime.timedelta(minutes=1)
+        )
+        bot.check_pending_requests()
+    assert mock_post_failure_notification.call_count == 2
+    assert bot.container_publishes == {}
+    assert len(bot.deadlines) == 0